@@ -1,53 +1,110 @@
 import argparse
 import asyncio
+import bisect
+import concurrent.futures
 import configparser
+import contextlib
+import heapq
+import itertools
 import ipaddress
+import json
+import math
+import multiprocessing
 import os
+import random
+import secrets
+import socket
+import sqlite3
+import struct
+import tempfile
 import time
+import zlib
+from array import array
 from collections import defaultdict, deque
-from typing import Dict, List, Set, Tuple, Optional
+from typing import Dict, List, NamedTuple, Set, Tuple, Optional
 
 import dns.asyncresolver
+import dns.message
+import dns.name
+import dns.rdatatype
 import httpx
 from colorama import Fore, Style, init
 from tqdm import tqdm
 
 init(autoreset=True)
 
+THROUGHPUT_WINDOW = 30.0
+
+MIN_THROUGHPUT = 0.01
+
 class ProgressTracker:
-    def __init__(self, total: int, stats: Dict, unique_ips_set: Set[str],
-                 num_dns_servers: int = 1, rate_limit: int = 10, domains_count: int = 0):
+    def __init__(self, total: int, stats: Dict, unique_ips_set: Tuple[Set[int], Set[int]],
+                 num_dns_servers: int = 1, rate_limit: int = 10, domains_count: int = 0,
+                 display: bool = True, history: Optional[Dict[str, float]] = None):
         self.total = total
+        self.display = display
         self.stats = stats
         self.unique_ips = unique_ips_set
         self.pbar = None
-        self.lock = asyncio.Lock()
+        self.workers: List['DNSServerWorker'] = []
         self.num_dns_servers = num_dns_servers
         self.rate_limit = rate_limit
         self.domains_count = domains_count
         self.effective_rate = num_dns_servers * rate_limit
+        self.current_rate = 0.0
+        self.slowest = None
         self.start_time = time.time()
+        self.started = time.monotonic()
+        self.history = history or {}
+        self.samples: Dict[Optional[str], deque] = defaultdict(deque)
+        self.cache = None
     
+    def add_domains(self, count: int):
+        self.domains_count += count
+        self.add_queries(count * self.num_dns_servers)
+
+    def add_queries(self, count: int):
+        self.total += count
+        self.stats['total_domains'] = self.total
+        if self.pbar is not None:
+            self.pbar.total = self.total
+        elif self.display:
+            self.start()
+
     def start(self):
         self.pbar = tqdm(
             total=self.total,
-            bar_format='[{bar:40}] {percentage:3.1f}% | Прошло: {elapsed} | Осталось (примерно): {desc}',
+            bar_format='[{bar:30}] {percentage:3.1f}% | Прошло: {elapsed} | Осталось (примерно): {desc}{postfix}',
             unit=' запр',
-            ncols=120,
+            ncols=160,
             leave=True,
             mininterval=0,
             desc='расчет...'
         )
 
+    def collect_stats(self):
+        if not self.workers:
+            return
+        totals = defaultdict(int)
+        for worker in self.workers:
+            for key, value in worker.stats.items():
+                totals[key] += value
+        self.stats['total_domains_processed'] = totals['processed']
+        for outcome in ('nxdomain', 'no_answer', 'timeout', 'servfail'):
+            self.stats[outcome] = totals[outcome]
+        self.stats['domain_errors'] = totals['timeout'] + totals['servfail'] + totals['error']
+
     async def update_progress(self):
+        self.collect_stats()
         if self.pbar:
-            async with self.lock:
-                processed = self.stats.get('total_domains_processed', 0)
-                remaining_time = self.calculate_remaining_time()
+            processed = self.stats.get('total_domains_processed', 0)
+            remaining_time = self.calculate_remaining_time()
 
-                self.pbar.n = processed
-                self.pbar.set_description_str(remaining_time)
-                self.pbar.refresh()
+            self.pbar.n = processed
+            self.pbar.set_description_str(remaining_time, refresh=False)
+            if self.workers:
+                self.pbar.set_postfix_str(self.describe_load(), refresh=False)
+            self.pbar.refresh()
 
     def format_time(self, seconds: float) -> str:
         if seconds < 0:
@@ -56,20 +113,66 @@ class ProgressTracker:
         secs = int(seconds % 60)
         return f"{mins:02d}:{secs:02d}"
 
-    def calculate_remaining_time(self) -> str:
-        processed = self.stats.get('total_domains_processed', 0)
-        remaining = self.total - processed
+    def measured_rate(self, key: Optional[str], processed: int, now: float) -> Optional[float]:
+        window = self.samples[key]
+        window.append((now, processed))
+        while len(window) > 2 and now - window[0][0] > THROUGHPUT_WINDOW:
+            window.popleft()
+        elapsed = now - window[0][0]
+        if elapsed < 5:
+            return None
+        return max((processed - window[0][1]) / elapsed, MIN_THROUGHPUT)
+
+    def worker_rate(self, worker: 'DNSServerWorker', now: float) -> float:
+        rate = self.measured_rate(worker.name, worker.stats['processed'], now)
+        if rate is None:
+            rate = self.history.get(worker.name) or worker.rate_limit * len(worker.nameservers)
+        return rate
+
+    def estimate(self) -> Tuple[float, float, Optional['DNSServerWorker']]:
+        now = time.monotonic()
+        if not self.workers:
+            processed = self.stats.get('total_domains_processed', 0)
+            rate = self.measured_rate(None, processed, now) or sum(self.history.values()) or self.effective_rate
+            return (self.total - processed) / rate if rate > 0 else 0.0, rate, None
+        unqueued = max(0, self.total - sum(worker.queued for worker in self.workers)) / len(self.workers)
+        total_rate = 0.0
+        remaining_time = 0.0
+        slowest = None
+        for worker in self.workers:
+            rate = self.worker_rate(worker, now)
+            total_rate += rate
+            worker_time = (worker.queued - worker.stats['processed'] + unqueued) / rate
+            if slowest is None or worker_time > remaining_time:
+                remaining_time = worker_time
+                slowest = worker
+        return remaining_time, total_rate, slowest
 
-        if self.effective_rate > 0:
-            time_remaining = remaining / self.effective_rate
-            return self.format_time(time_remaining)
-        return "00:00"
+    def calculate_remaining_time(self) -> str:
+        remaining_time, self.current_rate, self.slowest = self.estimate()
+        return self.format_time(remaining_time)
+
+    def describe_load(self) -> str:
+        inflight = sum(len(worker.inflight) for worker in self.workers)
+        line = f"{self.current_rate:.0f} запр/сек, в работе {inflight}"
+        if self.slowest is not None and len(self.workers) > 1:
+            line += f", медленнее всех {self.slowest.name}"
+        return line
+
+    def throughput(self) -> Dict[str, float]:
+        rates = {}
+        for worker in self.workers:
+            elapsed = worker.last_done - self.started
+            if worker.stats['processed'] and elapsed > 0:
+                rates[worker.name] = round(worker.stats['processed'] / elapsed, 1)
+        return rates
 
     def close(self):
         if self.pbar:
             self.pbar.n = self.total
             self.pbar.refresh()
             self.pbar.close()
+        run_metrics.throughput.update(self.throughput())
 
         elapsed = time.time() - self.stats['start_time']
         total = self.stats['total_domains']
@@ -77,14 +180,21 @@ class ProgressTracker:
         errors = self.stats['domain_errors']
 
         error_pct = (errors / total * 100) if total > 0 else 0
-        total_ips_found = len(self.unique_ips) + self.stats['null_ips_count'] + self.stats.get('cloudflare_ips_count', 0)
+        unique_count = sum(len(unique) for unique in self.unique_ips)
+        total_ips_found = (unique_count + self.stats['null_ips_count'] + self.stats.get('cloudflare_ips_count', 0)
+                           + self.stats.get('excluded_ips_count', 0))
         null_pct = (self.stats['null_ips_count'] / total_ips_found * 100) if total_ips_found > 0 else 0
         cf_pct = (self.stats.get('cloudflare_ips_count', 0) / total_ips_found * 100) if total_ips_found > 0 else 0
+        excluded_pct = (self.stats.get('excluded_ips_count', 0) / total_ips_found * 100) if total_ips_found > 0 else 0
 
         print(f"\n{yellow('Проверка завершена.')}")
         print(f"{Style.BRIGHT}Всего обработано DNS имен:{Style.RESET_ALL} {processed} из {total}")
-        print(f"{Style.BRIGHT}Разрешено уникальных IP-адресов:{Style.RESET_ALL} {len(self.unique_ips)}")
-        print(f"{Style.BRIGHT}Ошибок разрешения доменов:{Style.RESET_ALL} {errors} ({error_pct:.1f}%)")
+        print(f"{Style.BRIGHT}Разрешено уникальных IP-адресов:{Style.RESET_ALL} {unique_count}")
+        print(f"{Style.BRIGHT}Ошибок разрешения доменов:{Style.RESET_ALL} {errors} ({error_pct:.1f}%)" + (
+            f", из них таймаутов {self.stats.get('timeout', 0)}, отказов DNS серверов {self.stats.get('servfail', 0)}" if errors else ''))
+        if self.stats.get('nxdomain', 0) or self.stats.get('no_answer', 0):
+            print(f"{Style.BRIGHT}Несуществующих DNS имен (NXDOMAIN):{Style.RESET_ALL} {self.stats.get('nxdomain', 0)}, "
+                  f"{Style.BRIGHT}без записей нужного типа:{Style.RESET_ALL} {self.stats.get('no_answer', 0)}")
 
         if self.stats['null_ips_count'] > 0:
             print(f"{Style.BRIGHT}Исключено IP-адресов 'заглушек':{Style.RESET_ALL} {self.stats['null_ips_count']} ({null_pct:.1f}%)")
@@ -92,6 +202,14 @@ class ProgressTracker:
         if self.stats.get('cloudflare_ips_count', 0) > 0:
             print(f"{Style.BRIGHT}Исключено IP-адресов Cloudflare:{Style.RESET_ALL} {self.stats['cloudflare_ips_count']} ({cf_pct:.1f}%)")
 
+        if self.stats.get('excluded_ips_count', 0) > 0:
+            print(f"{Style.BRIGHT}Исключено IP-адресов по спискам исключений:{Style.RESET_ALL} {self.stats['excluded_ips_count']} ({excluded_pct:.1f}%)")
+
+        if self.cache is not None:
+            lookups = self.cache.hits + self.cache.misses
+            hit_pct = (self.cache.hits / lookups * 100) if lookups > 0 else 0
+            print(f"{Style.BRIGHT}Кэш DNS ответов:{Style.RESET_ALL} попаданий {self.cache.hits} ({hit_pct:.1f}%), промахов {self.cache.misses}")
+
 class PeriodicProgressUpdater:
     def __init__(self, progress_tracker: ProgressTracker, stats: Dict):
         self.progress_tracker = progress_tracker
@@ -182,19 +300,53 @@ def read_config(cfg_file):
         dns_server_indices = list(map(int, config.get('dnsserver', '').split())) if config.get('dnsserver') else []
         mk_list_name = config.get('listname') or ''
         subnet = config.get('subnet') or ''
+        max_routes = int(config.get('max_routes') or 0)
+        ipv6 = config.get('ipv6') or 'no'
+        subnet6 = config.get('subnet6') or '64'
+        diff = config.get('diff') or 'no'
         cfginfo = config.get('cfginfo') or 'yes'
         ken_gateway = config.get('keenetic') or ''
         localplatform = config.get('localplatform') or ''
         localdns = config.get('localdns') or ''
         mk_comment = config.get('mk_comment') or 'off'
+        concurrency = int(config.get('concurrency') or 100)
+        adaptive = config.get('adaptive') or 'yes'
+        rate_limit_max = int(config.get('rate_limit_max') or 0)
+        servers_per_domain = int(config.get('servers_per_domain') or 0)
+        servers_agreement = float(config.get('servers_agreement') or 0.5)
+        servers_audit = float(config.get('servers_audit') or 0)
+        retries = int(config.get('retries') or 2)
+        retry_budget = float(config.get('retry_budget') or 0.1)
+        hedge = int(config.get('hedge') or 95)
+        backend = config.get('backend') or 'resolver'
+        cache = config.get('cache') or 'no'
+        cache_min_ttl = int(config.get('cache_min_ttl') or 0)
+        cache_refresh = config.get('cache_refresh') or 'no'
+        negative_cache = config.get('negative_cache') or 'no'
+        negative_max_days = float(config.get('negative_max_days') or 7)
+        negative_revalidate = float(config.get('negative_revalidate') or 0.05)
+        exclude = config.get('exclude', '').split()
+        daemon_min_interval = int(config.get('daemon_min_interval') or 60)
+        daemon_rebuild_interval = int(config.get('daemon_rebuild_interval') or 30)
+        report = config.get('report') or ''
+        prometheus = config.get('prometheus') or ''
 
         if cfginfo in ['yes', 'y']:
             print(f"{yellow(f'Загружена конфигурация из {cfg_file}:')}")
             print(f"{Style.BRIGHT}Сервисы для проверки:{Style.RESET_ALL} {service if service else 'спросить у пользователя'}")
             print(f"{Style.BRIGHT}Использовать DNS сервер:{Style.RESET_ALL} {dns_server_indices if dns_server_indices else 'спросить у пользователя'}")
             print(f"{Style.BRIGHT}Лимит запросов к каждому DNS серверу (запросов/сек):{Style.RESET_ALL} {rate_limit}")
+            print(f"{Style.BRIGHT}Одновременных запросов к каждому DNS серверу:{Style.RESET_ALL} {concurrency}")
+            print(f"{Style.BRIGHT}Опрос DNS серверов для каждого имени:{Style.RESET_ALL} {f'сначала {servers_per_domain}, остальные при совпадении ответов менее {servers_agreement:.0%}' + (f', выборочная проверка {servers_audit:.0%} имен' if servers_audit else '') if servers_per_domain else 'все выбранные'}")
+            print(f"{Style.BRIGHT}Повтор запросов при таймаутах и сбоях:{Style.RESET_ALL} {f'до {retries} раз, не более {retry_budget:.0%} от числа запросов' if retries else 'выключен'}, дублирующий запрос {f'после {hedge}-го перцентиля задержки' if hedge else 'выключен'}")
+            print(f"{Style.BRIGHT}Адаптивный лимит и таймауты по задержке DNS серверов:{Style.RESET_ALL} {f'включены, до {rate_limit_max or rate_limit} запросов/сек' if adaptive in ['yes', 'y'] else 'выключены'}")
+            print(f"{Style.BRIGHT}Механизм разрешения DNS:{Style.RESET_ALL} {'UDP (один сокет на DNS сервер)' if backend == 'udp' else 'dnspython resolver'}")
+            print(f"{Style.BRIGHT}Кэш DNS ответов:{Style.RESET_ALL} {('включен' + (f', минимальный TTL {cache_min_ttl} сек' if cache_min_ttl else '') + (', принудительное обновление' if cache_refresh in ['yes', 'y'] else '')) if cache in ['yes', 'y'] else 'выключен'}")
+            print(f"{Style.BRIGHT}Пропуск недоступных DNS имен (NXDOMAIN, таймауты):{Style.RESET_ALL} {f'включен, повтор через растущий интервал до {negative_max_days:g} дн., выборочная перепроверка {negative_revalidate:.0%}' if negative_cache in ['yes', 'y'] else 'выключен'}")
+            print(f"{Style.BRIGHT}Списки исключений IP-адресов:{Style.RESET_ALL} {', '.join(exclude) if exclude else 'не указаны'}")
             print(f"{Style.BRIGHT}Фильтрация IP-адресов Cloudflare:{Style.RESET_ALL} {'включена' if cloudflare in ['y', 'yes'] else 'выключена' if cloudflare in ['n', 'no'] else 'спросить у пользователя'}")
-            print(f"{Style.BRIGHT}Агрегация IP-адресов:{Style.RESET_ALL} {'mix режим /24 (255.255.255.0) + /32 (255.255.255.255)' if subnet == 'mix' else 'до /16 подсети (255.255.0.0)' if subnet == '16' else 'до /24 подсети (255.255.255.0)' if subnet == '24' else 'выключена' if subnet in ['n', 'no'] else 'спросить у пользователя'}")
+            print(f"{Style.BRIGHT}Агрегация IP-адресов:{Style.RESET_ALL} {'mix режим /24 (255.255.255.0) + /32 (255.255.255.255)' if subnet == 'mix' else 'точная, минимальный набор подсетей' + (f', не более {max_routes} маршрутов' if max_routes else '') if subnet == 'collapse' else 'до /16 подсети (255.255.0.0)' if subnet == '16' else 'до /24 подсети (255.255.255.0)' if subnet == '24' else 'выключена' if subnet in ['n', 'no'] else 'спросить у пользователя'}")
+            print(f"{Style.BRIGHT}IPv6 (AAAA записи):{Style.RESET_ALL} {('включен, агрегация ' + ('точная, минимальный набор подсетей' if subnet6 == 'collapse' else f'до /{subnet6} подсети' if subnet6 in ['48', '64'] else 'выключена')) if ipv6 in ['yes', 'y'] else 'выключен'}")
             print(f"{Style.BRIGHT}Формат сохранения:{Style.RESET_ALL} {'только IP' if filetype == 'ip' else 'Linux route' if filetype == 'unix' else 'CIDR-нотация' if filetype == 'cidr' else 'Windows route' if filetype == 'win' else 'Mikrotik CLI' if filetype == 'mikrotik' else 'open vpn' if filetype == 'ovpn' else 'Keenetic CLI' if filetype == 'keenetic' else 'Wireguard' if filetype == 'wireguard' else 'спросить у пользователя'}")
             
             if filetype in ['win', 'unix', '']:
@@ -205,15 +357,18 @@ def read_config(cfg_file):
                 print(f"{Style.BRIGHT}Имя списка для Mikrotik firewall:{Style.RESET_ALL} {mk_list_name if mk_list_name else 'спросить у пользователя'}")
                 print(f"{Style.BRIGHT}'comment=' в Mikrotik firewall:{Style.RESET_ALL} {'выключен' if mk_comment == 'off' else 'включен'}")
             print(f"{Style.BRIGHT}Сохранить результат в файл:{Style.RESET_ALL} {filename}")
+            print(f"{Style.BRIGHT}Только изменения с прошлого запуска:{Style.RESET_ALL} {'да' if diff in ['yes', 'y'] else 'нет'}")
             print(f"{Style.BRIGHT}Выполнить по завершению:{Style.RESET_ALL} {run_command if run_command else 'не указано'}")
+            print(f"{Style.BRIGHT}Отчет о запуске:{Style.RESET_ALL} {', '.join(filter(None, [report, prometheus and f'{prometheus} (Prometheus)'])) or 'не сохраняется'}")
+            print(f"{Style.BRIGHT}Режим демона (--daemon):{Style.RESET_ALL} повторный запрос не чаще раза в {daemon_min_interval} сек, обновление результата не чаще раза в {daemon_rebuild_interval} сек")
             print(f"{Style.BRIGHT}Локальный список платформ:{Style.RESET_ALL} {'включен' if str(localplatform).strip().lower() in ('yes', 'y') else 'выключен'}")
             print(f"{Style.BRIGHT}Локальный список DNS серверов:{Style.RESET_ALL} {'включен' if str(localdns).strip().lower() in ('yes', 'y') else 'выключен'}")
 
-        return service, rate_limit, filename, cloudflare, filetype, gateway, run_command, dns_server_indices, mk_list_name, subnet, ken_gateway, localplatform, localdns, mk_comment
+        return service, rate_limit, filename, cloudflare, filetype, gateway, run_command, dns_server_indices, mk_list_name, subnet, ken_gateway, localplatform, localdns, mk_comment, concurrency, backend, cache, cache_min_ttl, cache_refresh, exclude, max_routes, diff, daemon_min_interval, daemon_rebuild_interval, ipv6, subnet6, adaptive, rate_limit_max, servers_per_domain, servers_agreement, servers_audit, retries, retry_budget, hedge, negative_cache, negative_max_days, negative_revalidate, report, prometheus
 
     except Exception as e:
         print(f"{yellow(f'Ошибка загрузки {cfg_file}:')} {e}\n{Style.BRIGHT}Используются настройки 'по умолчанию'.{Style.RESET_ALL}")
-        return '', 50, 'domain-ip-resolve.txt', '', '', '', '', [], '', '', '', '', '', 'off'
+        return '', 50, 'domain-ip-resolve.txt', '', '', '', '', [], '', '', '', '', '', 'off', 100, 'resolver', 'no', 0, 'no', [], 0, 'no', 60, 30, 'no', '64', 'yes', 0, 0, 0.5, 0.0, 2, 0.1, 95, 'no', 7, 0.05, '', ''
 
 def gateway_input(gateway):
     if not gateway:
@@ -229,107 +384,1164 @@ def ken_gateway_input(ken_gateway):
     else:
         return ken_gateway
 
+class RateLimiter:
+    def __init__(self, rate: float):
+        self.rate = float(rate)
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.acquired = 0
+        self.wait_time = 0.0
+        self.first_acquire = None
+        self.last_acquire = None
+
+    def set_rate(self, rate: float):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.rate = float(rate)
+        self.capacity = max(1.0, self.rate)
+
+    async def acquire(self, count: int = 1):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= count
+        delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        granted = now + delay
+
+        if self.first_acquire is None:
+            self.first_acquire = granted
+        self.last_acquire = granted
+        self.acquired += count
+
+        if delay > 0:
+            self.wait_time += delay
+            await asyncio.sleep(delay)
+
+    @property
+    def average_rate(self) -> float:
+        if self.acquired < 2 or self.last_acquire == self.first_acquire:
+            return 0.0
+        return (self.acquired - 1) / (self.last_acquire - self.first_acquire)
+
+rate_limiters: Dict[str, RateLimiter] = {}
+
+def get_rate_limiter(nameserver: str, rate_limit: int) -> RateLimiter:
+    limiter = rate_limiters.get(nameserver)
+    if limiter is None:
+        limiter = RateLimiter(rate_limit)
+        rate_limiters[nameserver] = limiter
+    return limiter
+
+class ServerController:
+    def __init__(self, limiter: RateLimiter, max_rate: float, base_timeout: float = 10.0,
+                 min_timeout: float = 0.5, max_timeout: float = 30.0):
+        self.limiter = limiter
+        self.min_rate = 1.0
+        self.max_rate = max(float(max_rate), self.min_rate)
+        self.base_timeout = base_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max(max_timeout, base_timeout)
+        self.timeout = base_timeout
+        self.latencies = deque(maxlen=256)
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.backoff = 0.0
+        self.backoff_started = 0.0
+        self.backoff_until = 0.0
+        self.last_decrease = 0.0
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self.backoff_until
+
+    @property
+    def p95(self) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def record_success(self, latency: float):
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.backoff = 0.0
+        self.latencies.append(latency)
+        if self.successes % 32 == 0:
+            self.timeout = min(self.base_timeout, max(self.min_timeout, 3 * self.p95))
+
+        rate = self.limiter.rate
+        if rate < self.max_rate:
+            self.limiter.set_rate(min(self.max_rate, rate + self.max_rate / 20 / rate))
+
+    def record_failure(self, started: Optional[float] = None):
+        self.failures += 1
+        now = time.monotonic()
+        if started is not None and started < self.backoff_started:
+            return
+        self.consecutive_failures += 1
+        self.timeout = min(self.max_timeout, self.timeout * 1.5)
+
+        if now - self.last_decrease >= self.timeout:
+            self.last_decrease = now
+            self.limiter.set_rate(max(self.min_rate, self.limiter.rate / 2))
+
+        if self.consecutive_failures >= 5 and now >= self.backoff_until:
+            self.consecutive_failures = 0
+            self.backoff = min(60.0, self.backoff * 2 if self.backoff else 1.0)
+            self.backoff_started = now
+            self.backoff_until = now + self.backoff
+
+server_controllers: Dict[str, ServerController] = {}
+
+def get_server_controller(nameserver: str, rate_limit: int, max_rate: float) -> ServerController:
+    controller = server_controllers.get(nameserver)
+    if controller is None:
+        controller = ServerController(get_rate_limiter(nameserver, rate_limit), max_rate)
+        server_controllers[nameserver] = controller
+    return controller
+
+def rate_limiter_summary() -> Dict[str, Dict[str, float]]:
+    summary = {}
+    for nameserver, limiter in rate_limiters.items():
+        entry = {'acquired': limiter.acquired, 'average_rate': limiter.average_rate, 'wait_time': limiter.wait_time}
+        controller = server_controllers.get(nameserver)
+        if controller is not None:
+            entry.update(p95=controller.p95, timeout=controller.timeout, rate=limiter.rate,
+                         failures=controller.failures)
+        summary[nameserver] = entry
+    return summary
+
+def merge_rate_limiter_summaries(summaries: List[Dict[str, Dict[str, float]]]) -> Dict[str, Dict[str, float]]:
+    merged = {}
+    for summary in summaries:
+        for nameserver, entry in summary.items():
+            total = merged.setdefault(nameserver, {})
+            for key, value in entry.items():
+                total[key] = max(total.get(key, 0), value) if key in ('p95', 'timeout') else total.get(key, 0) + value
+    return merged
+
+def print_rate_limiter_stats(summary: Optional[Dict[str, Dict[str, float]]] = None):
+    if summary is None:
+        summary = rate_limiter_summary()
+    for nameserver, entry in summary.items():
+        line = (f"  {nameserver}: {entry['acquired']} запр, {entry['average_rate']:.1f} запр/сек, "
+                f"суммарное ожидание лимита {entry['wait_time']:.1f} сек")
+        if 'p95' in entry:
+            line += (f", p95 {entry['p95'] * 1000:.0f} мс, таймаут {entry['timeout']:.1f} сек, "
+                     f"итоговый лимит {entry['rate']:.0f} запр/сек, сбоев {entry['failures']}")
+        print(line)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0)
+
+STAGE_NAMES = {
+    'list_load': 'загрузка списков',
+    'download': 'загрузка DNS имен',
+    'resolve': 'разрешение',
+    'filter': 'фильтрация',
+    'aggregate': 'агрегация',
+    'format': 'форматирование',
+    'write': 'запись'
+}
+
+def query_outcome(error: Optional[BaseException]) -> str:
+    if error is None:
+        return 'ok'
+    if isinstance(error, dns.resolver.NXDOMAIN):
+        return 'nxdomain'
+    if isinstance(error, dns.resolver.NoAnswer):
+        return 'no_answer'
+    if isinstance(error, (dns.resolver.Timeout, asyncio.TimeoutError)):
+        return 'timeout'
+    if isinstance(error, dns.resolver.NoNameservers):
+        return 'servfail'
+    if isinstance(error, asyncio.CancelledError):
+        return 'cancelled'
+    return 'error'
+
+class NameserverMetrics:
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.rate_limit_wait = 0.0
+        self.outcomes: Dict[str, int] = defaultdict(int)
+
+    @property
+    def count(self) -> int:
+        return sum(self.buckets)
+
+    def observe(self, latency: float, outcome: str):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        self.latency_sum += latency
+        self.outcomes[outcome] += 1
+
+    def quantile(self, fraction: float) -> Optional[float]:
+        rank = self.count * fraction
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+class RunMetrics:
+    def __init__(self):
+        self.started = time.time()
+        self.stages: Dict[str, float] = defaultdict(float)
+        self.nameservers: Dict[str, NameserverMetrics] = defaultdict(NameserverMetrics)
+        self.throughput: Dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - started
+
+    def add_stage(self, name: str, seconds: float):
+        self.stages[name] += seconds
+
+    def observe(self, nameserver: str, latency: float, outcome: str):
+        self.nameservers[nameserver].observe(latency, outcome)
+
+    def add_wait(self, nameserver: str, seconds: float):
+        self.nameservers[nameserver].rate_limit_wait += seconds
+
+    def snapshot(self) -> Dict[str, Tuple[List[int], float, float, Dict[str, int]]]:
+        return {nameserver: (metrics.buckets, metrics.latency_sum, metrics.rate_limit_wait, dict(metrics.outcomes))
+                for nameserver, metrics in self.nameservers.items()}
+
+    def merge(self, snapshot: Dict[str, Tuple[List[int], float, float, Dict[str, int]]]):
+        for nameserver, (buckets, latency_sum, rate_limit_wait, outcomes) in snapshot.items():
+            metrics = self.nameservers[nameserver]
+            metrics.buckets = [total + count for total, count in zip(metrics.buckets, buckets)]
+            metrics.latency_sum += latency_sum
+            metrics.rate_limit_wait += rate_limit_wait
+            for outcome, count in outcomes.items():
+                metrics.outcomes[outcome] += count
+
+    def report(self, stats: Dict, unique_ips: int, rate_summary: Optional[Dict[str, Dict[str, float]]] = None) -> Dict:
+        if rate_summary is None:
+            rate_summary = rate_limiter_summary()
+        nameservers = {}
+        for nameserver, metrics in self.nameservers.items():
+            limiter = rate_summary.get(nameserver, {})
+            nameservers[nameserver] = {
+                'queries': metrics.count,
+                'outcomes': dict(metrics.outcomes),
+                'latency_mean_seconds': round(metrics.latency_sum / metrics.count, 4) if metrics.count else 0.0,
+                'latency_p50_seconds': metrics.quantile(0.5),
+                'latency_p99_seconds': metrics.quantile(0.99),
+                'latency_buckets': {str(bound): count for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), metrics.buckets)},
+                'rate_limit_wait_seconds': round(metrics.rate_limit_wait, 3),
+                'average_rate': round(limiter.get('average_rate', 0.0), 1)
+            }
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'stages_seconds': {name: round(seconds, 3) for name, seconds in self.stages.items()},
+            'domains': {
+                'queries': stats.get('total_domains', 0),
+                'processed': stats.get('total_domains_processed', 0),
+                'errors': stats.get('domain_errors', 0),
+                'timeout': stats.get('timeout', 0),
+                'servfail': stats.get('servfail', 0),
+                'nxdomain': stats.get('nxdomain', 0),
+                'no_answer': stats.get('no_answer', 0)
+            },
+            'unique_ips': unique_ips,
+            'excluded_ips': {
+                'null': stats.get('null_ips_count', 0),
+                'cloudflare': stats.get('cloudflare_ips_count', 0),
+                'lists': stats.get('excluded_ips_count', 0)
+            },
+            'nameservers': nameservers,
+            'throughput': self.throughput
+        }
+
+    def prometheus(self, report: Dict) -> str:
+        lines = [
+            '# HELP domain_mapper_stage_seconds Wall time of each stage of the last run.',
+            '# TYPE domain_mapper_stage_seconds gauge'
+        ]
+        lines += [f'domain_mapper_stage_seconds{{stage="{name}"}} {seconds}' for name, seconds in report['stages_seconds'].items()]
+        lines += ['# HELP domain_mapper_domains DNS names of the last run by result.', '# TYPE domain_mapper_domains gauge']
+        lines += [f'domain_mapper_domains{{result="{name}"}} {value}' for name, value in report['domains'].items()]
+        lines += ['# HELP domain_mapper_unique_ips Unique IP addresses in the last result.', '# TYPE domain_mapper_unique_ips gauge',
+                  f"domain_mapper_unique_ips {report['unique_ips']}"]
+        lines += ['# HELP domain_mapper_query_duration_seconds DNS query latency per nameserver.',
+                  '# TYPE domain_mapper_query_duration_seconds histogram']
+        for nameserver, metrics in self.nameservers.items():
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), metrics.buckets):
+                cumulative += count
+                lines.append(f'domain_mapper_query_duration_seconds_bucket{{nameserver="{nameserver}",le="{bound}"}} {cumulative}')
+            lines.append(f'domain_mapper_query_duration_seconds_sum{{nameserver="{nameserver}"}} {metrics.latency_sum:.6f}')
+            lines.append(f'domain_mapper_query_duration_seconds_count{{nameserver="{nameserver}"}} {metrics.count}')
+        lines += ['# HELP domain_mapper_queries DNS queries per nameserver by outcome.', '# TYPE domain_mapper_queries gauge']
+        for nameserver, metrics in self.nameservers.items():
+            lines += [f'domain_mapper_queries{{nameserver="{nameserver}",outcome="{outcome}"}} {count}'
+                      for outcome, count in sorted(metrics.outcomes.items())]
+        lines += ['# HELP domain_mapper_rate_limit_wait_seconds Time spent waiting for the rate limit per nameserver.',
+                  '# TYPE domain_mapper_rate_limit_wait_seconds gauge']
+        lines += [f'domain_mapper_rate_limit_wait_seconds{{nameserver="{nameserver}"}} {metrics.rate_limit_wait:.3f}'
+                  for nameserver, metrics in self.nameservers.items()]
+        lines += ['# HELP domain_mapper_last_run_timestamp_seconds Time the last run finished.',
+                  '# TYPE domain_mapper_last_run_timestamp_seconds gauge', f'domain_mapper_last_run_timestamp_seconds {time.time():.0f}']
+        return '\n'.join(lines) + '\n'
+
+    def write(self, report_file: str, prometheus_file: str, stats: Dict, unique_ips: int,
+              rate_summary: Optional[Dict[str, Dict[str, float]]] = None):
+        if not report_file and not prometheus_file:
+            return
+        report = self.report(stats, unique_ips, rate_summary)
+        try:
+            if report_file:
+                write_file_atomic(report_file, json.dumps(report, ensure_ascii=False, indent=2, allow_nan=False) + '\n')
+            if prometheus_file:
+                write_file_atomic(prometheus_file, self.prometheus(report))
+        except OSError as e:
+            print(f"{red('Не удалось сохранить отчет о запуске:')} {e}")
+
+    def print_stages(self):
+        parts = [f"{STAGE_NAMES.get(name, name)} {seconds:.1f} сек" for name, seconds in self.stages.items()]
+        if parts:
+            print(f"{Style.BRIGHT}Время этапов:{Style.RESET_ALL} " + ', '.join(parts))
+
+run_metrics = RunMetrics()
+
+def load_throughput_history(report_file: str) -> Dict[str, float]:
+    if not report_file:
+        return {}
+    try:
+        with open(report_file, 'r', encoding='utf-8') as file:
+            history = json.load(file).get('throughput', {})
+    except (OSError, ValueError, AttributeError):
+        return {}
+    return {name: float(rate) for name, rate in history.items() if isinstance(rate, (int, float)) and rate > 0}
+
+DNS_TYPE_A = 1
+DNS_TYPE_CNAME = 5
+DNS_TYPE_AAAA = 28
+DNS_RCODE_NOERROR = 0
+DNS_RCODE_NXDOMAIN = 3
+DNS_QUERY_HEADER = struct.pack('!HHHHH', 0x0100, 1, 0, 0, 1)
+DNS_QUERY_EDNS = b'\x00' + struct.pack('!HHIH', 41, 1232, 0, 0)
+DNS_QUESTION_SUFFIX = {rdtype: struct.pack('!HH', rdtype, 1) for rdtype in (DNS_TYPE_A, DNS_TYPE_AAAA)}
+
+def encode_qname(domain: str) -> Tuple[bytes, str]:
+    if domain.isascii():
+        labels = domain.lower().rstrip('.').split('.')
+        wire = bytearray()
+        for label in labels:
+            if not 0 < len(label) < 64:
+                raise ValueError(f"некорректное доменное имя: {domain}")
+            wire.append(len(label))
+            wire += label.encode('ascii')
+        if len(wire) > 254:
+            raise ValueError(f"некорректное доменное имя: {domain}")
+        wire.append(0)
+        return bytes(wire), '.'.join(labels)
+    name = dns.name.from_text(domain)
+    return name.to_wire(), name.to_text(omit_final_dot=True).lower()
+
+def read_dns_name(data: bytes, offset: int) -> Tuple[str, int]:
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 64:
+                raise ValueError("петля сжатия в DNS ответе")
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+            continue
+        offset += 1
+        if length == 0:
+            break
+        labels.append(data[offset:offset + length].decode('latin-1'))
+        offset += length
+    return '.'.join(labels).lower(), end if end is not None else offset
+
+def parse_dns_response(data: bytes) -> Tuple[int, bool, List[Tuple[str, int, int, int, int]]]:
+    flags, qdcount, ancount = struct.unpack_from('!HHH', data, 2)
+    offset = 12
+    for _ in range(qdcount):
+        _, offset = read_dns_name(data, offset)
+        offset += 4
+    records = []
+    for _ in range(ancount):
+        name, offset = read_dns_name(data, offset)
+        rtype, _, ttl, rdlength = struct.unpack_from('!HHIH', data, offset)
+        offset += 10
+        records.append((name, rtype, ttl, offset, rdlength))
+        offset += rdlength
+    return flags & 0x000F, bool(flags & 0x0200), records
+
+class DNSAnswer(NamedTuple):
+    addresses: List[str]
+    ttl: int
+    target: str = ''
+    link_ttl: int = 0
+    negative: bool = False
+
+    @property
+    def valid_for(self) -> int:
+        return min(self.ttl, self.link_ttl) if self.target else self.ttl
+
+NO_ANSWER = DNSAnswer([], 0)
+
+NEGATIVE_ANSWER = DNSAnswer([], 0, negative=True)
+
+def extract_addresses(data: bytes, records: List[Tuple[str, int, int, int, int]], qname: str,
+                      rdtype: int = DNS_TYPE_A) -> DNSAnswer:
+    cnames = {}
+    addresses = defaultdict(list)
+    ttls = {}
+    for name, rtype, ttl, offset, rdlength in records:
+        if rtype == rdtype == DNS_TYPE_A and rdlength == 4:
+            addresses[name].append(socket.inet_ntoa(data[offset:offset + 4]))
+            ttls[name] = min(ttl, ttls.get(name, ttl))
+        elif rtype == rdtype == DNS_TYPE_AAAA and rdlength == 16:
+            addresses[name].append(socket.inet_ntop(socket.AF_INET6, data[offset:offset + 16]))
+            ttls[name] = min(ttl, ttls.get(name, ttl))
+        elif rtype == DNS_TYPE_CNAME:
+            cnames[name] = (read_dns_name(data, offset)[0], ttl)
+
+    name = qname
+    link_ttl = None
+    for _ in range(16):
+        if name in addresses:
+            if link_ttl is None:
+                return DNSAnswer(addresses[name], ttls[name])
+            return DNSAnswer(addresses[name], ttls[name], name, link_ttl)
+        if name not in cnames:
+            break
+        name, ttl = cnames[name]
+        link_ttl = ttl if link_ttl is None else min(link_ttl, ttl)
+    return NO_ANSWER
+
+def parse_negative_response(data: bytes) -> Optional[dns.message.Message]:
+    try:
+        response = dns.message.from_wire(data)
+    except Exception:
+        return None
+    return response if response.question else None
+
+def negative_ttl(error: Exception) -> int:
+    if isinstance(error, dns.resolver.NXDOMAIN):
+        responses = list((error.kwargs.get('responses') or {}).values())
+    else:
+        responses = [error.kwargs.get('response')]
+    for response in responses:
+        for rrset in getattr(response, 'authority', ()):
+            if rrset.rdtype == dns.rdatatype.SOA:
+                return min(rrset.ttl, rrset[0].minimum)
+    return 0
+
+class ResolverBackend:
+    def __init__(self, timeout: float = 10.0, lifetime: float = 15.0, port: int = 53):
+        self.timeout = timeout
+        self.lifetime = lifetime
+        self.port = port
+        self.resolvers: Dict[Tuple[str, ...], dns.asyncresolver.Resolver] = {}
+
+    def _get_resolver(self, nameservers: List[str]) -> dns.asyncresolver.Resolver:
+        key = tuple(nameservers)
+        resolver = self.resolvers.get(key)
+        if resolver is None:
+            resolver = dns.asyncresolver.Resolver()
+            resolver.nameservers = list(nameservers)
+            resolver.port = self.port
+            resolver.timeout = self.timeout
+            resolver.lifetime = self.lifetime
+            self.resolvers[key] = resolver
+        return resolver
+
+    async def resolve(self, domain: str, nameservers: List[str], rdtype: int = DNS_TYPE_A,
+                      timeout: Optional[float] = None) -> DNSAnswer:
+        resolver = self._get_resolver(nameservers)
+        if timeout is None:
+            response = await resolver.resolve(domain, rdtype)
+        else:
+            resolver.timeout = timeout
+            response = await resolver.resolve(
+                domain, rdtype, lifetime=min(self.lifetime, timeout * (len(nameservers) + 1)))
+        addresses = [ip.address for ip in response]
+        cnames = response.chaining_result.cnames
+        if cnames:
+            return DNSAnswer(addresses, response.rrset.ttl, response.canonical_name.to_text(omit_final_dot=True).lower(),
+                             min(cname.ttl for cname in cnames))
+        return DNSAnswer(addresses, max(0, int(response.expiration - time.time())))
+
+    async def close(self):
+        self.resolvers.clear()
+
+class UDPNameserverProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        self.closed = False
+        self.pending: Dict[int, Tuple[asyncio.Future, bytes]] = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            except OSError:
+                pass
+
+    def datagram_received(self, data: bytes, addr):
+        if len(data) < 12:
+            return
+        entry = self.pending.get(int.from_bytes(data[:2], 'big'))
+        if entry is None:
+            return
+        future, question = entry
+        if not future.done() and data[12:12 + len(question)].lower() == question:
+            future.set_result(data)
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        self.closed = True
+        for future, _ in self.pending.values():
+            if not future.done():
+                future.set_exception(exc or ConnectionError("сокет DNS закрыт"))
+
+    def allocate_id(self) -> int:
+        while True:
+            query_id = secrets.randbits(16)
+            if query_id not in self.pending:
+                return query_id
+
+class UDPBackend:
+    def __init__(self, timeout: float = 10.0, lifetime: float = 15.0, port: int = 53):
+        self.timeout = timeout
+        self.lifetime = lifetime
+        self.port = port
+        self.sockets: Dict[str, asyncio.Future] = {}
+
+    async def _connect(self, nameserver: str) -> UDPNameserverProtocol:
+        loop = asyncio.get_running_loop()
+        try:
+            _, protocol = await loop.create_datagram_endpoint(
+                UDPNameserverProtocol, remote_addr=(nameserver, self.port))
+            return protocol
+        except Exception:
+            self.sockets.pop(nameserver, None)
+            raise
+
+    async def _get_socket(self, nameserver: str) -> UDPNameserverProtocol:
+        connecting = self.sockets.get(nameserver)
+        if connecting is not None and connecting.done() and not connecting.exception() \
+                and connecting.result().closed:
+            connecting = None
+        if connecting is None:
+            connecting = asyncio.ensure_future(self._connect(nameserver))
+            self.sockets[nameserver] = connecting
+        return await asyncio.shield(connecting)
+
+    async def _query_udp(self, nameserver: str, question: bytes, timeout: float) -> bytes:
+        protocol = await self._get_socket(nameserver)
+        loop = asyncio.get_running_loop()
+        query_id = protocol.allocate_id()
+        future = loop.create_future()
+        protocol.pending[query_id] = (future, question)
+        timer = loop.call_later(timeout, lambda: future.done() or future.set_exception(asyncio.TimeoutError()))
+        try:
+            protocol.transport.sendto(query_id.to_bytes(2, 'big') + DNS_QUERY_HEADER + question + DNS_QUERY_EDNS)
+            return await future
+        finally:
+            timer.cancel()
+            protocol.pending.pop(query_id, None)
+
+    async def _query_tcp(self, nameserver: str, question: bytes, timeout: float) -> bytes:
+        async def exchange():
+            reader, writer = await asyncio.open_connection(nameserver, self.port)
+            try:
+                packet = secrets.token_bytes(2) + DNS_QUERY_HEADER + question + DNS_QUERY_EDNS
+                writer.write(len(packet).to_bytes(2, 'big') + packet)
+                await writer.drain()
+                length = int.from_bytes(await reader.readexactly(2), 'big')
+                return await reader.readexactly(length)
+            finally:
+                writer.close()
+
+        return await asyncio.wait_for(exchange(), timeout)
+
+    async def resolve(self, domain: str, nameservers: List[str], rdtype: int = DNS_TYPE_A,
+                      timeout: Optional[float] = None) -> DNSAnswer:
+        qname_wire, qname = encode_qname(domain)
+        question = qname_wire + DNS_QUESTION_SUFFIX[rdtype]
+        loop = asyncio.get_running_loop()
+        lifetime = self.lifetime if timeout is None else min(self.lifetime, timeout * (len(nameservers) + 1))
+        timeout = self.timeout if timeout is None else timeout
+        deadline = loop.time() + lifetime
+        failed = set()
+        backoff = 0.1
+
+        while True:
+            for nameserver in nameservers:
+                if nameserver in failed:
+                    continue
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise dns.resolver.LifetimeTimeout(timeout=lifetime, errors=[])
+                try:
+                    data = await self._query_udp(nameserver, question, min(timeout, remaining))
+                    rcode, truncated, records = parse_dns_response(data)
+                    if truncated:
+                        data = await self._query_tcp(nameserver, question, min(timeout, remaining))
+                        rcode, truncated, records = parse_dns_response(data)
+                except (asyncio.TimeoutError, OSError, EOFError):
+                    continue
+                except (ValueError, IndexError, struct.error):
+                    failed.add(nameserver)
+                    continue
+
+                if rcode == DNS_RCODE_NXDOMAIN:
+                    response = parse_negative_response(data)
+                    if response is None:
+                        raise dns.resolver.NXDOMAIN()
+                    raise dns.resolver.NXDOMAIN(qnames=[response.question[0].name],
+                                                responses={response.question[0].name: response})
+                if rcode != DNS_RCODE_NOERROR:
+                    failed.add(nameserver)
+                    continue
+
+                answer = extract_addresses(data, records, qname, rdtype)
+                if not answer.addresses:
+                    raise dns.resolver.NoAnswer(response=parse_negative_response(data))
+                return answer
+
+            if failed.issuperset(nameservers):
+                raise dns.resolver.NoNameservers()
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise dns.resolver.LifetimeTimeout(timeout=lifetime, errors=[])
+            await asyncio.sleep(min(backoff, remaining))
+            backoff = min(backoff * 2, 2.0)
+
+    async def close(self):
+        for connecting in self.sockets.values():
+            if connecting.done() and not connecting.exception():
+                connecting.result().transport.close()
+            else:
+                connecting.cancel()
+        self.sockets.clear()
+
+DNS_BACKENDS = {
+    'resolver': ResolverBackend,
+    'udp': UDPBackend
+}
+
+def create_dns_backend(name: str):
+    return DNS_BACKENDS.get(name, ResolverBackend)()
+
+class AnswerCache:
+    def __init__(self, path: Optional[str], min_ttl: int = 0, refresh: bool = False):
+        self.path = path
+        self.min_ttl = min_ttl
+        self.refresh = refresh
+        self.entries: Dict[Tuple[str, str], Tuple[List[str], float]] = {}
+        self.links: Dict[Tuple[str, str], Tuple[str, float]] = {}
+        self.pending: List[Tuple[str, str, str, float]] = []
+        self.pending_links: List[Tuple[str, str, str, float]] = []
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+
+    def open(self):
+        if self.path is None:
+            return
+        try:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                "domain TEXT NOT NULL, servers TEXT NOT NULL, addresses TEXT NOT NULL, expires REAL NOT NULL, "
+                "PRIMARY KEY (domain, servers))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS links ("
+                "domain TEXT NOT NULL, servers TEXT NOT NULL, target TEXT NOT NULL, expires REAL NOT NULL, "
+                "PRIMARY KEY (domain, servers))"
+            )
+            now = time.time()
+            self.connection.execute("DELETE FROM answers WHERE expires <= ?", (now,))
+            self.connection.execute("DELETE FROM links WHERE expires <= ?", (now,))
+            self.connection.commit()
+            if not self.refresh:
+                for domain, servers, addresses, expires in self.connection.execute(
+                        "SELECT domain, servers, addresses, expires FROM answers"):
+                    self.entries[(domain, servers)] = (addresses.split(), expires)
+                for domain, servers, target, expires in self.connection.execute(
+                        "SELECT domain, servers, target, expires FROM links"):
+                    self.links[(domain, servers)] = (target, expires)
+        except sqlite3.Error as e:
+            print(f"{red('Не удалось открыть кэш DNS ответов:')} {e}")
+            self.connection = None
+
+    def get_link(self, domain: str, servers: str) -> Optional[Tuple[str, int]]:
+        link = self.links.get((domain, servers))
+        now = time.time()
+        if link is not None and link[1] > now:
+            return link[0], int(link[1] - now)
+        return None
+
+    def get(self, domain: str, servers: str) -> Optional[DNSAnswer]:
+        now = time.time()
+        link = self.get_link(domain, servers)
+        entry = self.entries.get((link[0] if link else domain, servers))
+        if entry is not None and entry[1] > now:
+            self.hits += 1
+            if link:
+                return DNSAnswer(entry[0], int(entry[1] - now), link[0], link[1])
+            return DNSAnswer(entry[0], int(entry[1] - now))
+        self.misses += 1
+        return None
+
+    def put(self, domain: str, servers: str, answer: DNSAnswer):
+        now = time.time()
+        name = domain
+        if answer.target:
+            name = answer.target
+            link_expires = now + max(answer.link_ttl, self.min_ttl)
+            self.links[(domain, servers)] = (name, link_expires)
+            self.pending_links.append((domain, servers, name, link_expires))
+        expires = now + max(answer.ttl, self.min_ttl)
+        self.entries[(name, servers)] = (answer.addresses, expires)
+        self.pending.append((name, servers, ' '.join(answer.addresses), expires))
+
+    def flush(self):
+        if self.connection is None:
+            self.pending.clear()
+            self.pending_links.clear()
+            return
+        try:
+            self.connection.executemany("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?)", self.pending)
+            self.connection.executemany("INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?)", self.pending_links)
+            self.connection.commit()
+        except sqlite3.Error as e:
+            print(f"{red('Не удалось сохранить кэш DNS ответов:')} {e}")
+        finally:
+            self.pending.clear()
+            self.pending_links.clear()
+
+    def close(self):
+        self.flush()
+        if self.connection is None:
+            return
+        self.connection.close()
+        self.connection = None
+
+class NegativeCache:
+    def __init__(self, path: Optional[str], base_ttl: int = 3600, max_ttl: int = 7 * 86400,
+                 revalidate: float = 0.05, min_failures: int = 3):
+        self.path = path
+        self.min_failures = max(2, min_failures)
+        self.base_ttl = base_ttl
+        self.max_ttl = max_ttl
+        self.revalidate = revalidate
+        self.entries: Dict[Tuple[str, str], Tuple[int, float]] = {}
+        self.pending: Dict[Tuple[str, str], Optional[Tuple[int, float]]] = {}
+        self.skipped = 0
+        self.revalidated = 0
+        self.revived = 0
+        self.connection = None
+
+    def open(self):
+        if self.path is None:
+            return
+        try:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS negatives ("
+                "domain TEXT NOT NULL, servers TEXT NOT NULL, failures INTEGER NOT NULL, retry_at REAL NOT NULL, "
+                "PRIMARY KEY (domain, servers))"
+            )
+            self.connection.execute("DELETE FROM negatives WHERE retry_at <= ?", (time.time() - self.max_ttl,))
+            self.connection.commit()
+            for domain, servers, failures, retry_at in self.connection.execute(
+                    "SELECT domain, servers, failures, retry_at FROM negatives"):
+                self.entries[(domain, servers)] = (failures, retry_at)
+        except sqlite3.Error as e:
+            print(f"{red('Не удалось открыть кэш недоступных DNS имен:')} {e}")
+            self.connection = None
+
+    def skip(self, domain: str, servers: str) -> bool:
+        entry = self.entries.get((domain, servers))
+        if entry is None or entry[1] <= time.time():
+            return False
+        if random.random() < self.revalidate:
+            self.revalidated += 1
+            return False
+        self.skipped += 1
+        return True
+
+    def record_failure(self, domain: str, servers: str, negative_ttl: int = 0, transient: bool = False):
+        key = (domain, servers)
+        failures = self.entries.get(key, (0, 0.0))[0] + 1
+        backoffs = failures - (self.min_failures - 1 if transient else 0)
+        if backoffs <= 0:
+            delay = 0
+        elif backoffs == 1:
+            delay = negative_ttl or self.base_ttl
+        else:
+            delay = max(negative_ttl, self.base_ttl) * 2 ** min(backoffs - 1, 32)
+        entry = (failures, time.time() + min(delay, self.max_ttl))
+        self.entries[key] = entry
+        self.pending[key] = entry
+
+    def record_success(self, domain: str, servers: str):
+        key = (domain, servers)
+        if self.entries.pop(key, None) is not None:
+            self.revived += 1
+            self.pending[key] = None
+
+    def flush(self):
+        if self.connection is None:
+            self.pending.clear()
+            return
+        try:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO negatives VALUES (?, ?, ?, ?)",
+                [(domain, servers, *entry) for (domain, servers), entry in self.pending.items() if entry is not None])
+            self.connection.executemany(
+                "DELETE FROM negatives WHERE domain = ? AND servers = ?",
+                [key for key, entry in self.pending.items() if entry is None])
+            self.connection.commit()
+        except sqlite3.Error as e:
+            print(f"{red('Не удалось сохранить кэш недоступных DNS имен:')} {e}")
+        finally:
+            self.pending.clear()
+
+    def close(self):
+        self.flush()
+        if self.connection is None:
+            return
+        self.connection.close()
+        self.connection = None
+
+    def print_stats(self):
+        print(f"{Style.BRIGHT}Пропущено недоступных DNS имен (повтор позже):{Style.RESET_ALL} {self.skipped}, "
+              f"выборочно перепроверено {self.revalidated}, снова доступны {self.revived}")
+
+RETRYABLE_ERRORS = (dns.resolver.Timeout, dns.resolver.NoNameservers, asyncio.TimeoutError, OSError)
+
+class RetryPolicy:
+    def __init__(self, retries: int = 2, budget_ratio: float = 0.1, hedge_percentile: int = 95,
+                 base_delay: float = 0.25, max_delay: float = 4.0, min_budget: int = 20):
+        self.retries = retries
+        self.budget_ratio = budget_ratio
+        self.hedge_percentile = min(max(0, hedge_percentile), 99)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = float(min_budget)
+        self.retried = 0
+        self.exhausted = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def on_request(self):
+        self.budget += self.budget_ratio
+
+    def allow_retry(self, attempt: int) -> bool:
+        if attempt > self.retries:
+            return False
+        if self.budget < 1:
+            self.exhausted += 1
+            return False
+        self.budget -= 1
+        self.retried += 1
+        return True
+
+    def allow_hedge(self) -> bool:
+        if self.budget < 1:
+            return False
+        self.budget -= 1
+        self.hedged += 1
+        return True
+
+    def backoff(self, attempt: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
+
+    def print_stats(self):
+        print(f"{Style.BRIGHT}Повторных запросов после сбоев:{Style.RESET_ALL} {self.retried}"
+              + (f" (бюджет повторов исчерпан {self.exhausted} раз)" if self.exhausted else ""))
+        if self.hedge_percentile:
+            print(f"{Style.BRIGHT}Дублирующих запросов к медленным серверам:{Style.RESET_ALL} {self.hedged}, "
+                  f"из них ответили первыми {self.hedge_wins}")
+
 class DNSServerWorker:
-    def __init__(self, name: str, nameservers: List[str], rate_limit: int = 10, stats_lock=None):
+    def __init__(self, name: str, nameservers: List[str], rate_limit: int = 10,
+                 concurrency: int = 100, backend=None, cache: Optional[AnswerCache] = None,
+                 on_answer=None, ipv6: bool = False, adaptive_max_rate: int = 0,
+                 retry: Optional['RetryPolicy'] = None, negative: Optional[NegativeCache] = None):
         self.name = name
         self.nameservers = nameservers
+        self.servers_key = ' '.join(nameservers)
+        self.rdtypes = (DNS_TYPE_A, DNS_TYPE_AAAA) if ipv6 else (DNS_TYPE_A,)
+        self.cache_key = self.servers_key + (' AAAA' if ipv6 else '')
+        self.backend = backend or ResolverBackend()
+        self.cache = cache
+        self.on_answer = on_answer
+        self.rotations = [nameservers[index:] + nameservers[:index] for index in range(len(nameservers))]
         self.rate_limit = rate_limit
-        self.queue = asyncio.Queue()
-        self.request_times = deque()
-        self.results = []
-        self.stats = {
-            'processed': 0,
-            'errors': 0,
-            'success': 0
-        }
-        self.stats_lock = stats_lock or asyncio.Lock()
-        self.rate_limit_lock = asyncio.Lock()
+        self.concurrency = max(1, concurrency)
+        self.queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        self.rate_limiters = [get_rate_limiter(nameserver, rate_limit) for nameserver in nameservers]
+        self.controllers = [
+            get_server_controller(nameserver, rate_limit, adaptive_max_rate) for nameserver in nameservers
+        ] if adaptive_max_rate else None
+        self.next_nameserver = 0
+        self.consumers = []
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.retry = retry
+        self.negative = negative
+        self.latencies = deque(maxlen=256)
+        self.hedge_delay = None
+        self.results: Dict[str, 'PackedAddresses'] = {}
+        self.targets: Dict[str, str] = {}
+        self.stats: Dict[str, int] = defaultdict(int)
+        self.queued = 0
+        self.last_done = 0.0
 
     async def add_domain(self, domain: str):
+        self.queued += 1
         await self.queue.put(domain)
 
-    async def _enforce_rate_limit(self):
-        async with self.rate_limit_lock:
-            now = time.monotonic()
+    async def _enforce_rate_limit(self, tried: Set[int] = frozenset()) -> int:
+        started = time.monotonic()
+        count = len(self.nameservers)
+        for _ in range(count):
+            index = self.next_nameserver
+            self.next_nameserver = (index + 1) % count
+            if index not in tried and (self.controllers is None or self.controllers[index].available):
+                break
+        else:
+            if self.controllers is None:
+                index = self.next_nameserver
+                self.next_nameserver = (index + 1) % count
+            else:
+                candidates = [candidate for candidate in range(count) if candidate not in tried] or range(count)
+                index = min(candidates, key=lambda candidate: self.controllers[candidate].backoff_until)
+                await asyncio.sleep(max(0.0, self.controllers[index].backoff_until - time.monotonic()))
+        await self.rate_limiters[index].acquire(len(self.rdtypes))
+        run_metrics.add_wait(self.nameservers[index], time.monotonic() - started)
+        return index
+
+    async def _resolve(self, domain: str, nameservers: List[str], timeout: Optional[float] = None) -> DNSAnswer:
+        if len(self.rdtypes) == 1:
+            return await self.backend.resolve(domain, nameservers, DNS_TYPE_A, timeout)
+
+        results = await asyncio.gather(
+            *[self.backend.resolve(domain, nameservers, rdtype, timeout) for rdtype in self.rdtypes],
+            return_exceptions=True
+        )
+        answers = [result for result in results if isinstance(result, DNSAnswer) and result.addresses]
+        if not answers:
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+            return NO_ANSWER
+        linked = [answer for answer in answers if answer.target]
+        return DNSAnswer(
+            [ip for answer in answers for ip in answer.addresses],
+            min(answer.ttl for answer in answers),
+            linked[0].target if linked else '',
+            min(answer.link_ttl for answer in linked) if linked else 0
+        )
 
-            while self.request_times and now - self.request_times[0] >= 1.0:
-                self.request_times.popleft()
+    async def _observed_resolve(self, domain: str, index: int, nameservers: List[str],
+                                timeout: Optional[float] = None) -> DNSAnswer:
+        started = time.monotonic()
+        error = None
+        try:
+            return await self._resolve(domain, nameservers, timeout)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            run_metrics.observe(self.nameservers[index], time.monotonic() - started, query_outcome(error))
+
+    def record_latency(self, latency: float):
+        self.latencies.append(latency)
+        if self.retry is not None and self.retry.hedge_percentile and len(self.latencies) % 32 == 0:
+            ordered = sorted(self.latencies)
+            self.hedge_delay = ordered[min(len(ordered) - 1, len(ordered) * self.retry.hedge_percentile // 100)]
+
+    async def _query_server(self, name: str, index: int, tried: Set[int]) -> DNSAnswer:
+        if self.controllers is None:
+            return await self._observed_resolve(name, index, self.rotations[index])
+
+        for attempt in range(len(self.nameservers)):
+            if attempt:
+                index = await self._enforce_rate_limit(tried)
+            tried.add(index)
+            controller = self.controllers[index]
+            started = time.monotonic()
+            try:
+                answer = await self._observed_resolve(name, index, [self.nameservers[index]], controller.timeout)
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+                controller.record_success(time.monotonic() - started)
+                raise
+            except Exception as e:
+                controller.record_failure(started)
+                error = e
+                continue
+            controller.record_success(time.monotonic() - started)
+            return answer
+        raise error
+
+    async def _query(self, name: str, tried: Set[int]) -> DNSAnswer:
+        index = await self._enforce_rate_limit(tried)
+        tried.add(index)
+        started = time.monotonic()
+        try:
+            answer = await self._query_server(name, index, tried)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            self.record_latency(time.monotonic() - started)
+            raise
+        self.record_latency(time.monotonic() - started)
+        return answer
+
+    async def _resolve_hedged(self, name: str, tried: Set[int]) -> DNSAnswer:
+        primary = asyncio.ensure_future(self._query(name, tried))
+        if self.hedge_delay is None or len(self.nameservers) < 2:
+            return await primary
+
+        hedge = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=self.hedge_delay)
+            if done or not self.retry.allow_hedge():
+                return await primary
+
+            hedge = asyncio.ensure_future(self._query(name, tried))
+            pending = {primary, hedge}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    error = task.exception()
+                    if error is None or not isinstance(error, RETRYABLE_ERRORS):
+                        if task is hedge and error is None:
+                            self.retry.hedge_wins += 1
+                        return task.result()
+            raise error
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    async def _resolve_with_retries(self, name: str) -> DNSAnswer:
+        tried = set()
+        if self.retry is None:
+            return await self._query(name, tried)
+
+        self.retry.on_request()
+        attempt = 0
+        while True:
+            try:
+                return await self._resolve_hedged(name, tried)
+            except RETRYABLE_ERRORS:
+                attempt += 1
+                if not self.retry.allow_retry(attempt):
+                    raise
+                await asyncio.sleep(self.retry.backoff(attempt))
+
+    async def _resolve_shared(self, name: str) -> DNSAnswer:
+        pending = self.inflight.get(name)
+        if pending is None:
+            pending = asyncio.ensure_future(self._resolve_with_retries(name))
+            self.inflight[name] = pending
+            pending.add_done_callback(lambda _: self.inflight.pop(name, None))
+        return await asyncio.shield(pending)
 
-            if len(self.request_times) >= self.rate_limit:
-                sleep_time = 1.0 - (now - self.request_times[0])
-                if sleep_time > 0:
-                    await asyncio.sleep(sleep_time)
-                    now = time.monotonic()
-                    while self.request_times and now - self.request_times[0] >= 1.0:
-                        self.request_times.popleft()
+    def start(self):
+        self.consumers = [asyncio.create_task(self._consume()) for _ in range(self.concurrency)]
 
-            self.request_times.append(now)
+    async def finish(self):
+        for _ in self.consumers:
+            await self.queue.put(None)
+        await asyncio.gather(*self.consumers)
 
-    async def process_queue(self, global_stats: Dict[str, int]):
-        resolver = dns.asyncresolver.Resolver()
-        resolver.nameservers = self.nameservers
-        resolver.timeout = 10.0
-        resolver.lifetime = 15.0
+    def cancel(self):
+        for consumer in self.consumers:
+            consumer.cancel()
+        for pending in list(self.inflight.values()):
+            pending.cancel()
 
-        domains = []
-        while not self.queue.empty():
+    async def _consume(self):
+        while True:
             domain = await self.queue.get()
-            domains.append(domain)
-
-        async def process_single_domain(domain):
-            await self._enforce_rate_limit()
+            if domain is None:
+                self.queue.task_done()
+                return
+            answer = await self.process_single_domain(domain)
+            if self.on_answer is not None:
+                self.on_answer(self, domain, answer)
+            else:
+                self.record(domain, answer)
+            self.queue.task_done()
+
+    def record(self, domain: str, answer: DNSAnswer):
+        if answer.addresses:
+            self.results[domain] = pack_addresses(answer.addresses)
+            if answer.target:
+                self.targets[domain] = answer.target
+
+    def count(self, outcome: str):
+        self.stats['processed'] += 1
+        self.stats[outcome] += 1
+        self.last_done = time.monotonic()
+
+    async def process_single_domain(self, domain: str) -> DNSAnswer:
+        link = None
+        if self.cache is not None:
+            answer = self.cache.get(domain, self.cache_key)
+            if answer is not None:
+                self.count('cached')
+                return answer
+            link = self.cache.get_link(domain, self.cache_key)
+
+        if self.negative is not None and self.negative.skip(domain, self.cache_key):
+            self.count('skipped')
+            return NO_ANSWER
 
-            try:
-                response = await resolver.resolve(domain)
-                ips = [ip.address for ip in response]
-
-                async with self.stats_lock:
-                    global_stats['total_domains_processed'] += 1
-                    self.stats['processed'] += 1
-                    self.stats['success'] += 1
-
-                return ips
-            except dns.resolver.NoNameservers:
-                async with self.stats_lock:
-                    global_stats['total_domains_processed'] += 1
-                    global_stats['domain_errors'] += 1
-                    self.stats['processed'] += 1
-                    self.stats['errors'] += 1
-                return []
-            except dns.resolver.Timeout:
-                async with self.stats_lock:
-                    global_stats['total_domains_processed'] += 1
-                    global_stats['domain_errors'] += 1
-                    self.stats['processed'] += 1
-                    self.stats['errors'] += 1
-                return []
-            except dns.resolver.NXDOMAIN:
-                async with self.stats_lock:
-                    global_stats['total_domains_processed'] += 1
-                    global_stats['domain_errors'] += 1
-                    self.stats['processed'] += 1
-                    self.stats['errors'] += 1
-                return []
-            except dns.resolver.NoAnswer:
-                async with self.stats_lock:
-                    global_stats['total_domains_processed'] += 1
-                    global_stats['domain_errors'] += 1
-                    self.stats['processed'] += 1
-                    self.stats['errors'] += 1
-                return []
-            except Exception:
-                async with self.stats_lock:
-                    global_stats['total_domains_processed'] += 1
-                    global_stats['domain_errors'] += 1
-                    self.stats['processed'] += 1
-                    self.stats['errors'] += 1
-                return []
-
-        results = await asyncio.gather(*[process_single_domain(domain) for domain in domains], return_exceptions=True)
-
-        for result in results:
-            if isinstance(result, list):
-                self.results.extend(result)
+        try:
+            if link is None:
+                answer = await self._resolve_shared(domain)
+            else:
+                target, link_ttl = link
+                answer = await self._resolve_shared(target)
+                answer = DNSAnswer(answer.addresses, answer.ttl, answer.target or target,
+                                   min(link_ttl, answer.link_ttl) if answer.target else link_ttl)
+        except Exception as e:
+            outcome = query_outcome(e)
+            if self.negative is not None:
+                if outcome in ('nxdomain', 'no_answer'):
+                    self.negative.record_failure(domain, self.cache_key, negative_ttl(e))
+                elif outcome in ('timeout', 'servfail') and (self.stats['ok'] or self.stats['cached']):
+                    self.negative.record_failure(domain, self.cache_key, transient=True)
+            self.count(outcome)
+            return NEGATIVE_ANSWER if outcome in ('nxdomain', 'no_answer') else NO_ANSWER
+
+        if self.cache is not None:
+            self.cache.put(domain, self.cache_key, answer)
+        if self.negative is not None:
+            self.negative.record_success(domain, self.cache_key)
+        self.count('ok')
+        return answer
 
 async def load_urls(url: str) -> Dict[str, str]:
     try:
@@ -393,27 +1605,140 @@ async def load_dns_from_file() -> Dict[str, List[str]]:
         dns_servers = await load_dns_servers(dns_db_url)
         return dns_servers
 
-async def get_cloudflare_ips() -> Set[str]:
-    try:
-        client = await get_http_client()
-        response = await client.get("https://www.cloudflare.com/ips-v4/")
-        response.raise_for_status()
-        text = response.text
-        cloudflare_ips = set()
-        
-        for line in text.splitlines():
-            line = line.strip()
-            if '/' in line:
+def ip_to_int(ip: str) -> int:
+    return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+
+def ip6_to_int(ip: str) -> int:
+    return int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big')
+
+def int_to_ip(value: int, bits: int = 32) -> str:
+    if bits == 32:
+        return socket.inet_ntoa(value.to_bytes(4, 'big'))
+    return socket.inet_ntop(socket.AF_INET6, value.to_bytes(16, 'big'))
+
+class PackedAddresses(NamedTuple):
+    v4: array
+    v6: Tuple[int, ...] = ()
+
+    def __bool__(self) -> bool:
+        return bool(self.v4) or bool(self.v6)
+
+def pack_addresses(ips: List[str]) -> PackedAddresses:
+    v4 = set()
+    v6 = set()
+    for ip in ips:
+        try:
+            if ':' in ip:
+                v6.add(ip6_to_int(ip))
+            else:
+                v4.add(ip_to_int(ip))
+        except (OSError, ValueError):
+            continue
+    return PackedAddresses(array('I', sorted(v4)), tuple(sorted(v6)))
+
+NULL_ADDRESSES = (frozenset({ip_to_int('0.0.0.0'), ip_to_int('127.0.0.1')}),
+                  frozenset({ip6_to_int('::'), ip6_to_int('::1')}))
+
+def new_address_array(bits: int = 32):
+    return array('I') if bits == 32 else []
+
+def merge_ranges(ranges: List[Tuple[int, int]], bits: int = 32):
+    starts = new_address_array(bits)
+    ends = new_address_array(bits)
+    for start, end in sorted(ranges):
+        if ends and start <= ends[-1] + 1:
+            if end > ends[-1]:
+                ends[-1] = end
+        else:
+            starts.append(start)
+            ends.append(end)
+    return starts, ends
+
+class IPRangeSet:
+    def __init__(self, networks=()):
+        self.starts = array('I')
+        self.ends = array('I')
+        self.starts6: List[int] = []
+        self.ends6: List[int] = []
+        self.update(networks)
+
+    def update(self, networks):
+        ranges = list(zip(self.starts, self.ends))
+        ranges6 = list(zip(self.starts6, self.ends6))
+        for network in networks:
+            if not isinstance(network, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
                 try:
-                    network = ipaddress.ip_network(line)
-                    for ip in network:
-                        cloudflare_ips.add(str(ip))
+                    network = ipaddress.ip_network(str(network).strip(), strict=False)
                 except ValueError:
                     continue
+            (ranges if network.version == 4 else ranges6).append(
+                (int(network.network_address), int(network.broadcast_address)))
+
+        self.starts, self.ends = merge_ranges(ranges)
+        self.starts6, self.ends6 = merge_ranges(ranges6, 128)
+
+    def contains(self, value: int, bits: int = 32) -> bool:
+        starts, ends = (self.starts, self.ends) if bits == 32 else (self.starts6, self.ends6)
+        if not starts:
+            return False
+        index = bisect.bisect_right(starts, value) - 1
+        return index >= 0 and value <= ends[index]
+
+    def __contains__(self, ip) -> bool:
+        if isinstance(ip, int):
+            return self.contains(ip)
+        try:
+            if ':' in ip:
+                return self.contains(ip6_to_int(ip), 128)
+            return self.contains(ip_to_int(ip))
+        except (OSError, ValueError, TypeError):
+            return False
+
+    def __len__(self) -> int:
+        return len(self.starts) + len(self.starts6)
+
+    def __bool__(self) -> bool:
+        return bool(self.starts) or bool(self.starts6)
+
+async def get_cloudflare_ips() -> IPRangeSet:
+    try:
+        client = await get_http_client()
+        cloudflare_ips = IPRangeSet()
+        for url in ("https://www.cloudflare.com/ips-v4/", "https://www.cloudflare.com/ips-v6/"):
+            response = await client.get(url)
+            response.raise_for_status()
+            cloudflare_ips.update(line for line in response.text.splitlines() if '/' in line)
         return cloudflare_ips
     except Exception as e:
         print("Ошибка при получении IP адресов Cloudflare:", e)
-        return set()
+        return IPRangeSet()
+
+def parse_cidr_lines(text: str) -> List[str]:
+    networks = []
+    for line in text.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if line:
+            networks.append(line.split()[0])
+    return networks
+
+async def load_exclusions(sources: List[str]) -> IPRangeSet:
+    async def fetch(source: str) -> List[str]:
+        try:
+            if source.startswith("http"):
+                client = await get_http_client()
+                response = await client.get(source)
+                response.raise_for_status()
+                return parse_cidr_lines(response.text)
+            with open(source, 'r', encoding='utf-8') as file:
+                return parse_cidr_lines(file.read())
+        except Exception as e:
+            print(f"{red('Ошибка при загрузке списка исключений')} {source}: {e}")
+            return []
+
+    excluded = IPRangeSet()
+    for networks in await asyncio.gather(*[fetch(source) for source in sources]):
+        excluded.update(networks)
+    return excluded
 
 async def load_dns_names(url_or_file: str) -> List[str]:
     if url_or_file.startswith("http"):
@@ -422,7 +1747,7 @@ async def load_dns_names(url_or_file: str) -> List[str]:
             response = await client.get(url_or_file)
             response.raise_for_status()
             return [line.strip() for line in response.text.splitlines() if line.strip()]
-        except httpx.HTTPStatusError as e:
+        except httpx.HTTPError as e:
             print(f"Ошибка при загрузке DNS имен: {e}")
             return []
     else:
@@ -433,52 +1758,570 @@ async def load_dns_names(url_or_file: str) -> List[str]:
             print(f"Ошибка при чтении файла {url_or_file}: {e}")
             return []
 
-async def resolve_dns_with_workers(service: str, dns_names: List[str],
-                                   dns_servers: List[Tuple[str, List[str]]],
-                                   cloudflare_ips: Set[str], unique_ips_all_services: Set[str],
-                                   stats: Dict[str, int], include_cloudflare: bool,
-                                   rate_limit: int, stats_lock: asyncio.Lock = None) -> str:
-    try:
-        if stats_lock is None:
-            stats_lock = asyncio.Lock()
-
-        workers = []
-        for server_name, servers in dns_servers:
-            worker = DNSServerWorker(server_name, servers, rate_limit, stats_lock)
-            workers.append(worker)
+async def stream_dns_names(selected_services: List[str], urls: Dict[str, str],
+                           local_dns_names: List[str]):
+    async def fetch(service_name: str) -> Tuple[str, List[str]]:
+        if service_name == 'Custom DNS list':
+            dns_names = local_dns_names
+        else:
+            dns_names = await load_dns_names(urls[service_name])
+        finished.append(time.perf_counter())
+        return service_name, dns_names
 
-        for domain in dns_names:
-            for worker in workers:
-                await worker.add_domain(domain)
+    started = time.perf_counter()
+    finished: List[float] = []
+    tasks = [asyncio.create_task(fetch(service_name)) for service_name in selected_services]
+    try:
+        for next_loaded in asyncio.as_completed(tasks):
+            yield await next_loaded
+        run_metrics.add_stage('download', max(finished, default=started) - started)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def normalize_domain(name: str) -> str:
+    return name.strip().lower().rstrip('.')
+
+class DomainRegistry:
+    def __init__(self):
+        self.owners: Dict[str, List[str]] = {}
+        self.service_domains: Dict[str, List[str]] = defaultdict(list)
+        self.answers: Dict[str, Dict[str, 'PackedAddresses']] = defaultdict(dict)
+        self.targets: Dict[str, str] = {}
+
+    def register(self, service: str, dns_names: List[str]) -> List[str]:
+        new_domains = []
+        for name in dns_names:
+            domain = normalize_domain(name)
+            if not domain:
+                continue
+            services = self.owners.get(domain)
+            if services is None:
+                self.owners[domain] = [service]
+                new_domains.append(domain)
+            elif service in services:
+                continue
+            else:
+                services.append(service)
+            self.service_domains[service].append(domain)
+        return new_domains
+
+    def add_answer(self, domain: str, servers: str, addresses: 'PackedAddresses', target: str = '') -> bool:
+        if target:
+            self.targets[domain] = target
+        server_answers = self.answers[domain]
+        previous = server_answers.get(servers)
+        server_answers[servers] = addresses
+        return previous != addresses
+
+    def remove_answer(self, domain: str, servers: str) -> bool:
+        server_answers = self.answers.get(domain)
+        if not server_answers or server_answers.pop(servers, None) is None:
+            return False
+        if not server_answers:
+            del self.answers[domain]
+            self.targets.pop(domain, None)
+        return True
 
-        tasks = [worker.process_queue(stats) for worker in workers]
+def cdn_zone(name: str) -> str:
+    return '.'.join(name.split('.')[-2:])
+
+def print_cname_targets(registry: DomainRegistry, selected_services: List[str], limit: int = 5):
+    lines = []
+    for service in selected_services:
+        zones = defaultdict(int)
+        for domain in registry.service_domains.get(service, []):
+            target = registry.targets.get(domain)
+            if target:
+                zones[cdn_zone(target)] += 1
+        if zones:
+            top = sorted(zones.items(), key=lambda item: (-item[1], item[0]))[:limit]
+            lines.append(f"  {service}: " + ', '.join(f"*.{zone} ({count} DNS имен)" for zone, count in top))
+    if lines:
+        print(f"{Style.BRIGHT}CDN, на которые ссылаются DNS имена (CNAME):{Style.RESET_ALL}")
+        print('\n'.join(lines))
+
+class SubsetCoordinator:
+    def __init__(self, subset: int, agreement: float = 0.5, audit_rate: float = 0.0,
+                 progress_tracker: Optional['ProgressTracker'] = None):
+        self.subset = max(1, subset)
+        self.agreement = agreement
+        self.audit_rate = audit_rate
+        self.progress_tracker = progress_tracker
+        self.workers: List['DNSServerWorker'] = []
+        self.downstream = None
+        self.offset = 0
+        self.pending: Dict[str, Dict] = {}
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.escalations: Set[asyncio.Task] = set()
+        self.stats = {
+            'domains': 0,
+            'queries': 0,
+            'escalated': 0,
+            'escalated_gain': 0,
+            'audited': 0,
+            'audit_found': 0,
+            'audit_total': 0
+        }
 
-        await asyncio.gather(*tasks)
+    def agrees(self, answers: List[Set[str]]) -> bool:
+        if not all(answers):
+            return False
+        common = set.intersection(*answers)
+        return len(common) >= self.agreement * len(set.union(*answers))
+
+    async def submit(self, domain: str):
+        count = len(self.workers)
+        subset = min(self.subset, count)
+        first = [self.workers[(self.offset + index) % count] for index in range(subset)]
+        self.offset = (self.offset + 1) % count
+        audit = subset < count and self.audit_rate > 0 and random.random() < self.audit_rate
+        targets = self.workers if audit else first
+
+        self.pending[domain] = {
+            'outstanding': len(targets),
+            'answers': {},
+            'first': first,
+            'audit': audit,
+            'initial': None
+        }
+        self.idle.clear()
+        self.stats['domains'] += 1
+        self.stats['queries'] += len(targets)
+        if audit and self.progress_tracker is not None:
+            self.progress_tracker.add_queries(count - subset)
+        for worker in targets:
+            await worker.add_domain(domain)
+
+    async def _escalate(self, domain: str, workers: List['DNSServerWorker']):
+        for worker in workers:
+            await worker.add_domain(domain)
 
-        all_nameservers = set()
-        for _, servers in dns_servers:
-            all_nameservers.update(servers)
+    def on_answer(self, worker: 'DNSServerWorker', domain: str, answer: DNSAnswer):
+        if self.downstream is not None:
+            self.downstream(worker, domain, answer)
+        else:
+            worker.record(domain, answer)
+
+        state = self.pending.get(domain)
+        if state is None:
+            return
+        state['answers'][worker] = set(answer.addresses)
+        state['outstanding'] -= 1
+        if state['outstanding'] > 0:
+            return
+
+        answers = state['answers']
+        if state['audit']:
+            found = set().union(*answers.values())
+            first = [answers[first_worker] for first_worker in state['first']]
+            policy_found = set().union(*first) if self.agrees(first) else found
+            self.stats['audited'] += 1
+            self.stats['audit_total'] += len(found)
+            self.stats['audit_found'] += len(policy_found)
+        elif state['initial'] is None and not self.agrees(list(answers.values())):
+            rest = [other for other in self.workers if other not in answers]
+            if rest:
+                state['initial'] = set().union(*answers.values())
+                state['outstanding'] = len(rest)
+                self.stats['escalated'] += 1
+                self.stats['queries'] += len(rest)
+                if self.progress_tracker is not None:
+                    self.progress_tracker.add_queries(len(rest))
+                task = asyncio.create_task(self._escalate(domain, rest))
+                self.escalations.add(task)
+                task.add_done_callback(self.escalations.discard)
+                return
+        elif state['initial'] is not None:
+            self.stats['escalated_gain'] += len(set().union(*answers.values()) - state['initial'])
+
+        del self.pending[domain]
+        if not self.pending:
+            self.idle.set()
+
+    async def wait(self):
+        await self.idle.wait()
+
+    def cancel(self):
+        for task in list(self.escalations):
+            task.cancel()
+
+    def print_stats(self, servers: int = 0):
+        servers = servers or len(self.workers)
+        full = self.stats['domains'] * servers
+        queries_pct = (self.stats['queries'] / full * 100) if full else 0
+        print(f"{Style.BRIGHT}Опрошено DNS серверов на имя:{Style.RESET_ALL} {min(self.subset, servers)} из "
+              f"{servers}, запросов {self.stats['queries']} из {full} ({queries_pct:.1f}%)")
+        print(f"{Style.BRIGHT}Дополнительный опрос при расхождении или пустых ответах:{Style.RESET_ALL} "
+              f"{self.stats['escalated']} DNS имен, найдено еще {self.stats['escalated_gain']} IP-адресов")
+        if self.stats['audited']:
+            audit_pct = (self.stats['audit_found'] / self.stats['audit_total'] * 100) if self.stats['audit_total'] else 100
+            print(f"{Style.BRIGHT}Выборочная проверка всеми серверами:{Style.RESET_ALL} {self.stats['audited']} DNS имен, "
+                  f"найдено {self.stats['audit_found']} из {self.stats['audit_total']} IP-адресов ({audit_pct:.1f}%)")
+
+class ResolveScheduler:
+    def __init__(self, registry: DomainRegistry, min_interval: int = 60, retry_interval: int = 300):
+        self.registry = registry
+        self.min_interval = max(1, min_interval)
+        self.retry_interval = max(self.min_interval, retry_interval)
+        self.queue: List[Tuple[float, int, str, 'DNSServerWorker']] = []
+        self.sequence = 0
+        self.changed = False
+
+    def on_answer(self, worker: 'DNSServerWorker', domain: str, answer: DNSAnswer):
+        if answer.addresses:
+            if self.registry.add_answer(domain, worker.servers_key, pack_addresses(answer.addresses), answer.target):
+                self.changed = True
+            delay = max(answer.valid_for, self.min_interval)
+        else:
+            if answer.negative and self.registry.remove_answer(domain, worker.servers_key):
+                self.changed = True
+            delay = self.retry_interval
+        self.sequence += 1
+        heapq.heappush(self.queue, (time.monotonic() + delay, self.sequence, domain, worker))
+
+    def next_due(self) -> Optional[float]:
+        return self.queue[0][0] if self.queue else None
+
+    def pop_due(self, now: float) -> List[Tuple[str, 'DNSServerWorker']]:
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            _, _, domain, worker = heapq.heappop(self.queue)
+            due.append((domain, worker))
+        return due
+
+async def resolve_dns_with_workers(dns_lists, dns_servers: List[Tuple[str, List[str]]],
+                                   registry: DomainRegistry, stats: Dict[str, int],
+                                   rate_limit: int, concurrency: int, backend,
+                                   progress_tracker: 'ProgressTracker',
+                                   cache: Optional[AnswerCache] = None,
+                                   on_answer=None, ipv6: bool = False,
+                                   adaptive_max_rate: int = 0,
+                                   coordinator: Optional[SubsetCoordinator] = None,
+                                   retry: Optional[RetryPolicy] = None,
+                                   negative: Optional[NegativeCache] = None) -> List['DNSServerWorker']:
+    worker_on_answer = on_answer
+    if coordinator is not None:
+        coordinator.downstream = on_answer
+        worker_on_answer = coordinator.on_answer
+
+    workers = []
+    for server_name, servers in dns_servers:
+        worker = DNSServerWorker(server_name, servers, rate_limit, concurrency, backend, cache,
+                                 worker_on_answer, ipv6, adaptive_max_rate, retry, negative)
+        worker.start()
+        workers.append(worker)
+    progress_tracker.workers += workers
+    if coordinator is not None:
+        coordinator.workers = workers
 
-        unique_ips_current_service = set()
-        for worker in workers:
-            for ip_address in worker.results:
-                if ip_address in ('127.0.0.1', '0.0.0.0') or ip_address in all_nameservers:
-                    stats['null_ips_count'] += 1
+    try:
+        async for service_name, dns_names in dns_lists:
+            new_domains = registry.register(service_name, dns_names)
+            if not new_domains:
+                continue
+            progress_tracker.add_domains(len(new_domains))
+            for domain in new_domains:
+                if coordinator is not None:
+                    await coordinator.submit(domain)
                     continue
+                for worker in workers:
+                    await worker.add_domain(domain)
+
+        if coordinator is not None:
+            await coordinator.wait()
+        if on_answer is not None:
+            await asyncio.gather(*[worker.queue.join() for worker in workers])
+            progress_tracker.collect_stats()
+            return workers
+        await asyncio.gather(*[worker.finish() for worker in workers])
+    except BaseException:
+        if coordinator is not None:
+            coordinator.cancel()
+        for worker in workers:
+            worker.cancel()
+        raise
+    progress_tracker.collect_stats()
+
+    for worker in workers:
+        for domain, addresses in worker.results.items():
+            registry.add_answer(domain, worker.servers_key, addresses, worker.targets.get(domain, ''))
+    return workers
+
+SHARD_COUNTERS = {
+    'retry': ('retried', 'exhausted', 'hedged', 'hedge_wins'),
+    'negative': ('skipped', 'revalidated', 'revived'),
+    'cache': ('hits', 'misses')
+}
+
+class ShardJob(NamedTuple):
+    index: int
+    domains: List[str]
+    dns_servers: List[Tuple[str, List[str]]]
+    queries_per_domain: int
+    rate_limit: float
+    concurrency: int
+    backend: str
+    ipv6: bool
+    adaptive_max_rate: float
+    cache_path: Optional[str]
+    cache_min_ttl: int
+    cache_refresh: bool
+    negative_path: Optional[str]
+    negative_max_ttl: int
+    negative_revalidate: float
+    servers_per_domain: int
+    servers_agreement: float
+    servers_audit: float
+    retries: int
+    retry_budget: float
+    hedge: int
+
+shard_progress = None
+
+def shard_of(domain: str, shards: int) -> int:
+    return zlib.crc32(domain.encode('utf-8')) % shards
+
+def init_shard_process(progress):
+    global shard_progress
+    shard_progress = progress
+
+def publish_shard_progress(index: int, stats: Dict[str, int], progress_tracker: ProgressTracker):
+    progress_tracker.collect_stats()
+    if shard_progress is not None:
+        shard_progress[2 * index] = stats['total_domains_processed']
+        shard_progress[2 * index + 1] = progress_tracker.total
+
+def pack_shard_answers(domains: List[str], registry: DomainRegistry) -> Dict[str, Tuple[array, array, array, bytes]]:
+    keys = sorted({key for answers in registry.answers.values() for key in answers})
+    packed = {}
+    for key in keys:
+        offsets = array('I', [0])
+        addresses = array('I')
+        offsets6 = array('I', [0])
+        addresses6 = bytearray()
+        for domain in domains:
+            packed_addresses = registry.answers.get(domain, {}).get(key)
+            if packed_addresses is not None:
+                addresses.extend(packed_addresses.v4)
+                for value in packed_addresses.v6:
+                    addresses6 += value.to_bytes(16, 'big')
+            offsets.append(len(addresses))
+            offsets6.append(len(addresses6) // 16)
+        packed[key] = (offsets, addresses, offsets6, bytes(addresses6))
+    return packed
+
+def unpack_shard_answers(domains: List[str], packed: Dict[str, Tuple[array, array, array, bytes]],
+                         targets: Dict[int, str], registry: DomainRegistry):
+    for key, (offsets, addresses, offsets6, addresses6) in packed.items():
+        for index, domain in enumerate(domains):
+            packed_addresses = PackedAddresses(
+                addresses[offsets[index]:offsets[index + 1]],
+                tuple(int.from_bytes(addresses6[position * 16:position * 16 + 16], 'big')
+                      for position in range(offsets6[index], offsets6[index + 1]))
+            )
+            if packed_addresses:
+                registry.add_answer(domain, key, packed_addresses, targets.get(index, ''))
+
+async def resolve_shard_async(job: ShardJob) -> Dict:
+    stats = {'total_domains_processed': 0, 'domain_errors': 0, 'nxdomain': 0, 'no_answer': 0, 'timeout': 0, 'servfail': 0}
+    progress_tracker = ProgressTracker(0, stats, (set(), set()), job.queries_per_domain, display=False)
+    registry = DomainRegistry()
+    coordinator = None
+    if 0 < job.servers_per_domain < len(job.dns_servers):
+        coordinator = SubsetCoordinator(job.servers_per_domain, job.servers_agreement, job.servers_audit,
+                                        progress_tracker)
+    retry = RetryPolicy(job.retries, job.retry_budget, job.hedge) if job.retries or job.hedge else None
+    cache = None
+    if job.cache_path:
+        cache = AnswerCache(job.cache_path, job.cache_min_ttl, job.cache_refresh)
+        cache.open()
+    negative = None
+    if job.negative_path:
+        negative = NegativeCache(job.negative_path, max_ttl=job.negative_max_ttl, revalidate=job.negative_revalidate)
+        negative.open()
+    backend = create_dns_backend(job.backend)
+
+    async def domains():
+        yield '', job.domains
+
+    async def report():
+        while True:
+            publish_shard_progress(job.index, stats, progress_tracker)
+            await asyncio.sleep(1)
 
-                if include_cloudflare and ip_address in cloudflare_ips:
-                    stats['cloudflare_ips_count'] += 1
-                    continue
+    reporter = asyncio.create_task(report())
+    try:
+        await resolve_dns_with_workers(
+            domains(), job.dns_servers, registry, stats, job.rate_limit, job.concurrency, backend,
+            progress_tracker, cache, None, job.ipv6, job.adaptive_max_rate, coordinator, retry, negative
+        )
+    finally:
+        reporter.cancel()
+        await close_resolution(backend, cache, negative=negative)
+    publish_shard_progress(job.index, stats, progress_tracker)
+
+    positions = {domain: index for index, domain in enumerate(job.domains)}
+    counters = {}
+    for name, source in (('retry', retry), ('negative', negative), ('cache', cache)):
+        if source is not None:
+            counters[name] = {field: getattr(source, field) for field in SHARD_COUNTERS[name]}
+    return {
+        'answers': pack_shard_answers(job.domains, registry),
+        'targets': {positions[domain]: target for domain, target in registry.targets.items()},
+        'stats': stats,
+        'rate_limiters': rate_limiter_summary(),
+        'metrics': run_metrics.snapshot(),
+        'throughput': progress_tracker.throughput(),
+        'counters': counters,
+        'coordinator': coordinator.stats if coordinator is not None else {}
+    }
 
-                if ip_address not in unique_ips_all_services:
-                    unique_ips_current_service.add(ip_address)
-                    unique_ips_all_services.add(ip_address)
+def resolve_shard(job: ShardJob) -> Dict:
+    return asyncio.run(resolve_shard_async(job))
+
+async def resolve_dns_sharded(dns_lists, job: ShardJob, shards: int, registry: DomainRegistry,
+                              stats: Dict[str, int], progress_tracker: ProgressTracker,
+                              counted: Dict[str, object]) -> Dict[str, Dict[str, float]]:
+    async for service_name, dns_names in dns_lists:
+        new_domains = registry.register(service_name, dns_names)
+        if new_domains:
+            progress_tracker.add_domains(len(new_domains))
+
+    parts = [[] for _ in range(shards)]
+    for domain in registry.owners:
+        parts[shard_of(domain, shards)].append(domain)
+    jobs = [job._replace(index=index, domains=domains) for index, domains in enumerate(parts) if domains]
+    if not jobs:
+        return {}
 
-        return '\n'.join(sorted(unique_ips_current_service)) + '\n' if unique_ips_current_service else ''
+    context = multiprocessing.get_context('spawn')
+    progress = context.Array('q', 2 * shards)
+    loop = asyncio.get_running_loop()
 
-    except Exception as e:
-        print(f"Не удалось сопоставить IP адреса {service} его доменным именам: {e}")
-        return ""
+    def follow():
+        stats['total_domains_processed'] = sum(progress[0::2])
+        total = sum(progress[1::2])
+        if total > progress_tracker.total:
+            progress_tracker.add_queries(total - progress_tracker.total)
+
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=len(jobs), mp_context=context, initializer=init_shard_process, initargs=(progress,))
+    try:
+        futures = [loop.run_in_executor(executor, resolve_shard, shard_job) for shard_job in jobs]
+        pending = set(futures)
+        while pending:
+            _, pending = await asyncio.wait(pending, timeout=1)
+            follow()
+        results = [future.result() for future in futures]
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    for shard_job, result in zip(jobs, results):
+        unpack_shard_answers(shard_job.domains, result['answers'], result['targets'], registry)
+        run_metrics.merge(result['metrics'])
+        for name, rate in result['throughput'].items():
+            run_metrics.throughput[name] = round(run_metrics.throughput.get(name, 0.0) + rate, 1)
+        for key in ('domain_errors', 'nxdomain', 'no_answer', 'timeout', 'servfail'):
+            stats[key] += result['stats'][key]
+        for name, values in result['counters'].items():
+            target = counted.get(name)
+            if target is not None:
+                for field, value in values.items():
+                    setattr(target, field, getattr(target, field) + value)
+        coordinator = counted.get('coordinator')
+        if coordinator is not None:
+            for key, value in result['coordinator'].items():
+                coordinator.stats[key] += value
+    stats['total_domains_processed'] = sum(result['stats']['total_domains_processed'] for result in results)
+    return merge_rate_limiter_summaries([result['rate_limiters'] for result in results])
+
+def collect_service_ips(service: str, registry: DomainRegistry,
+                        dns_servers: List[Tuple[str, List[str]]],
+                        cloudflare_ips: IPRangeSet, unique_ips_all_services: Tuple[Set[int], Set[int]],
+                        stats: Dict[str, int], include_cloudflare: bool,
+                        excluded_ips: Optional[IPRangeSet] = None) -> Tuple[List[int], List[int]]:
+    nameservers = pack_addresses([server for _, servers in dns_servers for server in servers])
+    service_ips = (set(), set())
+    for domain in registry.service_domains.get(service, []):
+        for addresses in registry.answers.get(domain, {}).values():
+            service_ips[0].update(addresses.v4)
+            service_ips[1].update(addresses.v6)
+
+    results = []
+    for values, bits, nulls, servers, unique in zip(service_ips, (32, 128), NULL_ADDRESSES,
+                                                    (set(nameservers.v4), set(nameservers.v6)),
+                                                    unique_ips_all_services):
+        current = []
+        for value in values:
+            if value in nulls or value in servers:
+                stats['null_ips_count'] += 1
+                continue
+
+            if include_cloudflare and cloudflare_ips.contains(value, bits):
+                stats['cloudflare_ips_count'] += 1
+                continue
+
+            if excluded_ips and excluded_ips.contains(value, bits):
+                stats['excluded_ips_count'] += 1
+                continue
+
+            if value not in unique:
+                unique.add(value)
+                current.append(value)
+        results.append(sorted(current))
+    return results[0], results[1]
+
+def collect_addresses(selected_services: List[str], registry: DomainRegistry,
+                      dns_servers: List[Tuple[str, List[str]]],
+                      cloudflare_ips: IPRangeSet, unique_ips_all_services: Tuple[Set[int], Set[int]],
+                      stats: Dict[str, int], include_cloudflare: bool,
+                      excluded_ips: Optional[IPRangeSet] = None) -> Tuple[array, List[int]]:
+    addresses = array('I')
+    addresses6 = []
+    for service_name in selected_services:
+        service_addresses, service_addresses6 = collect_service_ips(
+            service_name, registry, dns_servers, cloudflare_ips, unique_ips_all_services,
+            stats, include_cloudflare, excluded_ips
+        )
+        addresses.extend(service_addresses)
+        addresses6.extend(service_addresses6)
+    return addresses, addresses6
+
+async def close_resolution(backend, cache: Optional[AnswerCache], workers: List['DNSServerWorker'] = (),
+                           negative: Optional[NegativeCache] = None):
+    for worker in workers:
+        worker.cancel()
+    await backend.close()
+    if cache is not None:
+        cache.close()
+    if negative is not None:
+        negative.close()
+
+async def run_daemon(scheduler: ResolveScheduler, rebuild, rebuild_interval: int = 30,
+                     cache: Optional[AnswerCache] = None, negative: Optional[NegativeCache] = None):
+    await rebuild()
+    last_rebuild = time.monotonic()
+    while True:
+        now = time.monotonic()
+        for domain, worker in scheduler.pop_due(now):
+            await worker.add_domain(domain)
+
+        if scheduler.changed and now - last_rebuild >= rebuild_interval:
+            scheduler.changed = False
+            last_rebuild = now
+            if cache is not None:
+                cache.flush()
+            if negative is not None:
+                negative.flush()
+            await rebuild()
+
+        next_due = scheduler.next_due()
+        delay = rebuild_interval if next_due is None else next_due - now
+        if scheduler.changed:
+            delay = min(delay, last_rebuild + rebuild_interval - now)
+        await asyncio.sleep(min(max(delay, 0.1), rebuild_interval))
 
 def check_service_config(service, urls, local_dns_names):
     if service:
@@ -582,13 +2425,14 @@ def mk_list_name_input(mk_list_name):
 def comment(selected_service):
     return ",".join(["".join(word.title() for word in s.split()) for s in selected_service])
 
-def subnet_input(subnet):
+def subnet_input(subnet, max_routes=0):
     if not subnet:
         choice = input(
             f"\n{yellow('Объединить IP-адреса в подсети?')}"
             f"\n1. сократить до {green('/16')} (255.255.0.0)"
             f"\n2. сократить до {green('/24')} (255.255.255.0)"
             f"\n3. сократить до {green('/24')} + {green('/32')} (255.255.255.0 и 255.255.255.255)"
+            f"\n4. точная агрегация до {green('минимального')} набора подсетей"
             f"\n{green('Enter')} - пропустить"
             f"\nВаш выбор: "
         ).strip()
@@ -599,115 +2443,393 @@ def subnet_input(subnet):
             subnet = '24'
         elif choice == '3':
             subnet = 'mix'
+        elif choice == '4':
+            subnet = 'collapse'
+            if not max_routes:
+                limit = input(f"Максимальное {green('количество маршрутов')} ({green('Enter')} - без ограничения): ").strip()
+                max_routes = int(limit) if limit.isdigit() else 0
         else:
             subnet = '32'
 
-    return subnet if subnet in {'16', '24', 'mix'} else '32'
+    return (subnet if subnet in {'16', '24', 'mix', 'collapse'} else '32'), max_routes
+
+PREFIX_NETMASKS = [str(ipaddress.IPv4Network(f'0.0.0.0/{prefixlen}').netmask) for prefixlen in range(33)]
+
+def range_to_prefixes(start: int, end: int, bits: int = 32):
+    while start <= end:
+        size = start & -start if start else 1 << bits
+        while size > end - start + 1:
+            size >>= 1
+        yield start, bits - size.bit_length() + 1
+        start += size
+
+def collapse_prefixes(networks, prefixlens, bits: int = 32) -> Tuple[array, array]:
+    ranges = sorted((network, network + (1 << (bits - prefixlen)) - 1)
+                    for network, prefixlen in zip(networks, prefixlens))
+    merged_networks = new_address_array(bits)
+    merged_prefixlens = array('B')
+    range_start = range_end = None
+    for start, end in ranges:
+        if range_end is not None and start <= range_end + 1:
+            if end > range_end:
+                range_end = end
+            continue
+        if range_end is not None:
+            for network, prefixlen in range_to_prefixes(range_start, range_end, bits):
+                merged_networks.append(network)
+                merged_prefixlens.append(prefixlen)
+        range_start, range_end = start, end
+    if range_end is not None:
+        for network, prefixlen in range_to_prefixes(range_start, range_end, bits):
+            merged_networks.append(network)
+            merged_prefixlens.append(prefixlen)
+    return merged_networks, merged_prefixlens
+
+def collapse_addresses(addresses, bits: int = 32) -> Tuple[array, array]:
+    return collapse_prefixes(addresses, [bits] * len(addresses), bits)
+
+def fit_prefixes(networks, prefixlens, max_routes: int, bits: int = 32) -> Tuple[array, array]:
+    count = len(networks)
+    if max_routes <= 0 or count <= max_routes:
+        return networks, prefixlens
+
+    starts = list(networks)
+    ends = [network + (1 << (bits - prefixlen)) - 1 for network, prefixlen in zip(networks, prefixlens)]
+    prev_node = list(range(-1, count - 1))
+    next_node = list(range(1, count + 1))
+    next_node[-1] = -1
+    alive = [True] * count
+    version = [0] * count
+
+    def candidate(left: int, right: int):
+        span = (starts[left] ^ ends[right]).bit_length()
+        super_start = (starts[left] >> span) << span
+        super_end = super_start + (1 << span) - 1
+        covered = 0
+        node = left
+        while node != -1 and starts[node] >= super_start:
+            covered += ends[node] - starts[node] + 1
+            node = prev_node[node]
+        node = next_node[left]
+        while node != -1 and ends[node] <= super_end:
+            covered += ends[node] - starts[node] + 1
+            node = next_node[node]
+        return (1 << span) - covered, super_start, super_end
+
+    heap = [(candidate(left, left + 1)[0], left, 0, 0) for left in range(count - 1)]
+    heapq.heapify(heap)
+
+    while count > max_routes and heap:
+        _, left, left_version, right_version = heapq.heappop(heap)
+        right = next_node[left] if alive[left] else -1
+        if right == -1 or version[left] != left_version or version[right] != right_version:
+            continue
+
+        _, super_start, super_end = candidate(left, right)
+        node = prev_node[left]
+        while node != -1 and starts[node] >= super_start:
+            alive[node] = False
+            count -= 1
+            node = prev_node[node]
+        first = node
+        node = next_node[left]
+        while node != -1 and ends[node] <= super_end:
+            alive[node] = False
+            count -= 1
+            node = next_node[node]
+        last = node
+
+        starts[left] = super_start
+        ends[left] = super_end
+        version[left] += 1
+        prev_node[left] = first
+        next_node[left] = last
+        if first != -1:
+            next_node[first] = left
+            cost, _, _ = candidate(first, left)
+            heapq.heappush(heap, (cost, first, version[first], version[left]))
+        if last != -1:
+            prev_node[last] = left
+            cost, _, _ = candidate(left, last)
+            heapq.heappush(heap, (cost, left, version[left], version[last]))
+
+    fitted = [index for index in range(len(starts)) if alive[index]]
+    return collapse_prefixes(
+        [starts[index] for index in fitted],
+        [bits - (ends[index] - starts[index] + 1).bit_length() + 1 for index in fitted],
+        bits
+    )
 
-def group_ips_in_subnets_optimized(filename: str, subnet: str):
+def group_ips_in_subnets_optimized(addresses, subnet: str, max_routes: int = 0, bits: int = 32) -> Tuple[array, array]:
+    addresses = sorted(set(addresses))
+    label = 'IP-адреса' if bits == 32 else 'IPv6-адреса'
+
+    if subnet == "collapse":
+        networks, prefixlens = collapse_addresses(addresses, bits)
+        print(f"{Style.BRIGHT}{label} агрегированы до минимального набора подсетей:{Style.RESET_ALL} {len(networks)}")
+
+        if max_routes and len(networks) > max_routes:
+            networks, prefixlens = fit_prefixes(networks, prefixlens, max_routes, bits)
+            covered = sum(1 << (bits - prefixlen) for prefixlen in prefixlens)
+            print(f"{Style.BRIGHT}Подсети расширены до лимита {max_routes} маршрутов:{Style.RESET_ALL} "
+                  f"{len(networks)}, дополнительно охвачено {covered - len(addresses)} {'IP-адресов' if bits == 32 else 'IPv6-адресов'}")
+        return networks, prefixlens
+
+    if subnet.isdigit() and int(subnet) < bits:
+        prefixlen = int(subnet)
+        mask = ((1 << bits) - 1) ^ ((1 << (bits - prefixlen)) - 1)
+        networks = new_address_array(bits)
+        networks.extend(sorted({address & mask for address in addresses}))
+        print(f"{Style.BRIGHT}{label} агрегированы до /{subnet} подсети{Style.RESET_ALL}")
+        return networks, array('B', [prefixlen]) * len(networks)
+
+    if subnet == "mix" and bits == 32:
+        octet_groups = defaultdict(list)
+        for address in addresses:
+            octet_groups[address & 0xFFFFFF00].append(address)
+
+        networks = array('I')
+        prefixlens = array('B')
+        for key in sorted(octet_groups):
+            group = octet_groups[key]
+            if len(group) > 1:
+                networks.append(key)
+                prefixlens.append(24)
+            else:
+                networks.append(group[0])
+                prefixlens.append(32)
+
+        print(f"{Style.BRIGHT}IP-адреса агрегированы до масок /24 и /32{Style.RESET_ALL}")
+        return networks, prefixlens
+
+    networks = new_address_array(bits)
+    networks.extend(addresses)
+    return networks, array('B', [bits]) * len(networks)
+
+def route_budget_warning(label: str, used: int, max_routes: int):
+    print(red(f"{label} заняли {used} маршрутов из лимита {max_routes}, лимит не соблюден. "
+              f"Для соблюдения лимита используйте агрегацию collapse"))
+
+def group_ip_families(addresses, addresses6, subnet: str, subnet6: str,
+                      max_routes: int = 0) -> Tuple[array, array, array, array]:
+    if not max_routes:
+        networks, prefixlens = group_ips_in_subnets_optimized(addresses, subnet)
+        networks6, prefixlens6 = group_ips_in_subnets_optimized(addresses6, subnet6, 0, 128)
+        return networks, prefixlens, networks6, prefixlens6
+
+    if subnet6 != 'collapse':
+        networks6, prefixlens6 = group_ips_in_subnets_optimized(addresses6, subnet6, 0, 128)
+        budget = max_routes - len(networks6)
+        if budget < 1 and addresses:
+            route_budget_warning('IPv6 подсети', len(networks6), max_routes)
+            budget = 0
+        networks, prefixlens = group_ips_in_subnets_optimized(addresses, subnet, budget)
+        return networks, prefixlens, networks6, prefixlens6
+
+    budget = max_routes
+    if subnet == 'collapse' and addresses and addresses6:
+        needed6 = len(collapse_addresses(sorted(set(addresses6)), 128)[0])
+        share = round(max_routes * len(addresses) / (len(addresses) + len(addresses6)))
+        budget = max(1, min(max_routes - 1, max(share, max_routes - needed6)))
+    networks, prefixlens = group_ips_in_subnets_optimized(addresses, subnet, budget)
+    budget6 = max_routes - len(networks)
+    if budget6 < 1 and addresses6:
+        route_budget_warning('IPv4 подсети', len(networks), max_routes)
+        budget6 = 0
+    networks6, prefixlens6 = group_ips_in_subnets_optimized(addresses6, subnet6, budget6, 128)
+    return networks, prefixlens, networks6, prefixlens6
+
+def open_temp_file(filename: str, buffering: int = -1):
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(filename)}.", suffix='.tmp', dir=directory)
     try:
-        with open(filename, 'r', encoding='utf-8') as file:
-            ips = {line.strip() for line in file if line.strip()}
-
-        subnets = set()
-
-        if subnet == "16":
-            for ip in ips:
-                try:
-                    network = ipaddress.IPv4Network(f"{ip}/16", strict=False)
-                    subnets.add(str(network.network_address))
-                except ValueError:
-                    continue
-            print(f"{Style.BRIGHT}IP-адреса агрегированы до /16 подсети{Style.RESET_ALL}")
-
-        elif subnet == "24":
-            for ip in ips:
-                try:
-                    network = ipaddress.IPv4Network(f"{ip}/24", strict=False)
-                    subnets.add(str(network.network_address))
-                except ValueError:
-                    continue
-            print(f"{Style.BRIGHT}IP-адреса агрегированы до /24 подсети{Style.RESET_ALL}")
-
-        elif subnet == "mix":
-            octet_groups = defaultdict(list)
-            for ip in ips:
-                key = '.'.join(ip.split('.')[:3])
-                octet_groups[key].append(ip)
-
-            for key, group in octet_groups.items():
-                if len(group) > 1:
-                    subnets.add(key + '.0')
-                else:
-                    subnets.update(group)
-            
-            print(f"{Style.BRIGHT}IP-адреса агрегированы до масок /24 и /32{Style.RESET_ALL}")
-
-        with open(filename, 'w', encoding='utf-8') as file:
-            for subnet_ip in sorted(subnets, key=lambda x: ipaddress.IPv4Address(x.split('/')[0])):
-                file.write(subnet_ip + '\n')
-
-    except Exception as e:
-        print(f"Ошибка при обработке файла: {e}")
-
-def split_file_by_lines(filename: str, max_lines: int = 999):
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_path, 0o666 & ~umask)
+        return temp_path, os.fdopen(fd, 'w', encoding='utf-8', buffering=buffering)
+    except BaseException:
+        os.close(fd)
+        os.remove(temp_path)
+        raise
+
+def write_file_atomic(filename: str, content: str):
+    temp_path, file = open_temp_file(filename)
     try:
-        with open(filename, 'r', encoding='utf-8') as file:
-            lines = file.readlines()
-
-        total_lines = len(lines)
-
-        if total_lines <= max_lines:
-            return False
-
-        base_name = filename.rsplit('.', 1)[0] if '.' in filename else filename
-        extension = '.' + filename.rsplit('.', 1)[1] if '.' in filename else '.txt'
-
-        num_parts = (total_lines + max_lines - 1) // max_lines
-
+        with file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, filename)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+class RouteFileWriter:
+    chunk_size = 4096
+
+    def __init__(self, filename: str, separator: str = '\n', terminator: str = '', max_lines: int = 0,
+                 buffer_size: int = 1 << 16):
+        self.filename = filename
+        self.separator = separator
+        self.terminator = terminator
+        self.max_lines = max_lines
+        self.buffer_size = buffer_size
+        self.parts: List[str] = []
+        self.counts: List[int] = []
+        self.file = None
+
+    def __enter__(self) -> 'RouteFileWriter':
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def _open_part(self):
+        if self.file is not None:
+            self._close_part('\n')
+        temp_path, self.file = open_temp_file(self.filename, self.buffer_size)
+        self.parts.append(temp_path)
+        self.counts.append(0)
+
+    def _close_part(self, terminator: str):
+        with self.file:
+            self.file.write(terminator)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.file = None
+
+    def write_lines(self, lines):
+        lines = iter(lines)
+        while True:
+            full = self.file is None or (self.max_lines and self.counts[-1] >= self.max_lines)
+            room = (self.max_lines if full else self.max_lines - self.counts[-1]) if self.max_lines else self.chunk_size
+            chunk = list(itertools.islice(lines, min(room, self.chunk_size)))
+            if not chunk:
+                return
+            if full:
+                self._open_part()
+            elif self.counts[-1]:
+                self.file.write(self.separator)
+            self.file.write(self.separator.join(chunk))
+            self.counts[-1] += len(chunk)
+
+    @property
+    def split(self) -> bool:
+        return len(self.parts) > 1
+
+    def commit(self):
+        if not self.parts:
+            self._open_part()
+        self._close_part(self.terminator if self.counts[-1] else '')
+        if not self.split:
+            os.replace(self.parts[0], self.filename)
+            return
+
+        base_name = self.filename.rsplit('.', 1)[0] if '.' in self.filename else self.filename
+        extension = '.' + self.filename.rsplit('.', 1)[1] if '.' in self.filename else '.txt'
         print(f"\n{Style.BRIGHT}Результаты сохранены в файлы:{Style.RESET_ALL}")
-        for part in range(num_parts):
-            start_index = part * max_lines
-            end_index = min((part + 1) * max_lines, total_lines)
-
+        for part, (temp_path, count) in enumerate(zip(self.parts, self.counts)):
             part_filename = f"{base_name}_p{part + 1}{extension}"
+            os.replace(temp_path, part_filename)
+            print(f"{Style.BRIGHT}{part_filename} ({count} строк){Style.RESET_ALL}")
+        print(f"{Style.BRIGHT}Разделение завершено. Создано {len(self.parts)} частей{Style.RESET_ALL}")
 
-            with open(part_filename, 'w', encoding='utf-8') as file:
-                file.writelines(lines[start_index:end_index])
-
-            print(f"{Style.BRIGHT}{part_filename} ({end_index - start_index} строк){Style.RESET_ALL}")
-
-        print(f"{Style.BRIGHT}Разделение завершено. Создано {num_parts} частей{Style.RESET_ALL}")
-
-        try:
-            os.remove(filename)
-        except Exception as e:
-            print(f"{red('Не удалось удалить исходный файл:')} {e}")
+        if os.path.exists(self.filename):
+            try:
+                os.remove(self.filename)
+            except Exception as e:
+                print(f"{red('Не удалось удалить исходный файл:')} {e}")
 
-        return True
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        for temp_path in self.parts:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
 
+class OutputFormat(NamedTuple):
+    add: str
+    remove: Optional[str] = None
+    add6: Optional[str] = None
+    remove6: Optional[str] = None
+    exact: Optional[str] = None
+    separator: str = '\n'
+    terminator: str = ''
+    max_lines: int = 0
+
+OUTPUT_FORMATS = {
+    'win': OutputFormat('route add {ip} mask {mask} {gateway}', 'route delete {ip} mask {mask} {gateway}'),
+    'unix': OutputFormat('ip route {ip}/{prefixlen} {gateway}', 'ip route del {ip}/{prefixlen} {gateway}',
+                         'ip route {ip}/{prefixlen} {gateway}', 'ip route del {ip}/{prefixlen} {gateway}'),
+    'keenetic bat': OutputFormat('route add {ip} mask {mask} 0.0.0.0', 'route delete {ip} mask {mask} 0.0.0.0',
+                                 max_lines=999),
+    'keenetic cli': OutputFormat('ip route {ip}/{prefixlen} {ken_gateway} auto !{comment}',
+                                 'no ip route {ip}/{prefixlen} {ken_gateway}',
+                                 'ipv6 route {ip}/{prefixlen} {ken_gateway} auto !{comment}',
+                                 'no ipv6 route {ip}/{prefixlen} {ken_gateway}'),
+    'cidr': OutputFormat('{ip}/{prefixlen}', add6='{ip}/{prefixlen}'),
+    'ovpn': OutputFormat('push "route {ip} {mask}"', add6='push "route-ipv6 {ip}/{prefixlen}"'),
+    'mikrotik': OutputFormat('/ip/firewall/address-list add list={list_name}{mk_comment} address={ip}/{prefixlen}',
+                             '/ip/firewall/address-list remove [find list={list_name} address={address}]',
+                             '/ipv6/firewall/address-list add list={list_name}{mk_comment} address={ip}/{prefixlen}',
+                             '/ipv6/firewall/address-list remove [find list={list_name} address={ip}/{prefixlen}]'),
+    'wireguard': OutputFormat('{ip}/{prefixlen}', add6='{ip}/{prefixlen}', separator=', '),
+    'ip': OutputFormat('{ip}', add6='{address}', exact='{ip}/{prefixlen}', terminator='\n')
+}
+
+def compile_template(template: Optional[str], constants: Dict[str, str], bits: int = 32):
+    if template is None:
+        return None
+    parts = []
+    for prefixlen in range(bits + 1):
+        fields = dict(constants, prefixlen=prefixlen, mask=PREFIX_NETMASKS[prefixlen] if bits == 32 else '',
+                      ip='\0', address='\0' if prefixlen == bits else f"\0/{prefixlen}")
+        parts.append(template.format_map(fields).split('\0'))
+    return lambda ip, prefixlen: ip.join(parts[prefixlen])
+
+def load_published_prefixes(state_file: str, key: str, bits: int = 32) -> Optional[Set[Tuple[int, int]]]:
+    try:
+        with open(state_file, 'r', encoding='utf-8') as file:
+            state = json.load(file)
+    except FileNotFoundError:
+        return None
     except Exception as e:
-        print(f"{red('Ошибка при разделении файла:')} {e}")
-        return False
-
-def process_file_format(filename, filetype, gateway, selected_service, mk_list_name, mk_comment, subnet, ken_gateway):
-    def read_file(filename):
-        try:
-            with open(filename, 'r', encoding='utf-8') as file:
-                return file.readlines()
-        except Exception as e:
-            print(f"Ошибка чтения файла: {e}")
-            return None
+        print(f"{red('Не удалось прочитать файл состояния:')} {e}")
+        return None
+
+    prefixes = state.get(key)
+    if prefixes is None:
+        return None
+    published = set()
+    for prefix in prefixes:
+        address, prefixlen = prefix.split('/')
+        published.add((ip_to_int(address) if bits == 32 else ip6_to_int(address), int(prefixlen)))
+    return published
+
+def save_published_prefixes(state_file: str, key: str, networks, prefixlens, bits: int = 32):
+    try:
+        with open(state_file, 'r', encoding='utf-8') as file:
+            state = json.load(file)
+    except Exception:
+        state = {}
 
-    def write_file(filename, ips, formatter):
-        formatted_ips = [formatter(ip.strip()) for ip in ips]
-        with open(filename, 'w', encoding='utf-8') as file:
-            if filetype.lower() == 'wireguard':
-                file.write(', '.join(formatted_ips))
-            else:
-                file.write('\n'.join(formatted_ips))
+    state[key] = [f"{int_to_ip(network, bits)}/{prefixlen}" for network, prefixlen in zip(networks, prefixlens)]
+    try:
+        write_file_atomic(state_file, json.dumps(state, ensure_ascii=False))
+    except Exception as e:
+        print(f"{red('Не удалось сохранить файл состояния:')} {e}")
 
-    net_mask = subnet if subnet == "mix" else "255.255.0.0" if subnet == "16" else "255.255.255.0" if subnet == "24" else "255.255.255.255"
+def format_input(filetype, gateway, ken_gateway, mk_list_name, selected_service, mk_comment, subnet):
+    net_mask = subnet if subnet in ("mix", "collapse") else "255.255.0.0" if subnet == "16" else "255.255.255.0" if subnet == "24" else "255.255.255.255"
 
     if not filetype:
         user_input = input(f"""
@@ -733,11 +2855,7 @@ def process_file_format(filename, filetype, gateway, selected_service, mk_list_n
             '7': 'ovpn',
             '8': 'wireguard'
         }
-        filetype = mapping.get(user_input, '')
-
-    ips = read_file(filename)
-    if not ips:
-        return
+        filetype = mapping.get(user_input, 'ip')
 
     if filetype in ['win', 'unix']:
         gateway = gateway_input(gateway)
@@ -746,43 +2864,64 @@ def process_file_format(filename, filetype, gateway, selected_service, mk_list_n
     elif filetype == 'mikrotik':
         mk_list_name = mk_list_name_input(mk_list_name)
 
-    formatters = {
-        'win': lambda ip: f"route add {ip} mask {net_mask} {gateway}",
-        'unix': lambda ip: f"ip route {ip}/{subnet} {gateway}",
-        'keenetic bat': lambda ip: f"route add {ip} mask {net_mask} 0.0.0.0",
-        'keenetic cli': lambda ip: f"ip route {ip}/{subnet} {ken_gateway} auto !{comment(selected_service)}",
-        'cidr': lambda ip: f"{ip}/{subnet}",
-        'ovpn': lambda ip: f'push "route {ip} {net_mask}"',
-        'mikrotik': lambda ip: f'/ip/firewall/address-list add list={mk_list_name}' + (f' comment="{comment(selected_service)}"' if mk_comment != "off" else "") + f' address={ip}/{subnet}',
-        'wireguard': lambda ip: f"{ip}/{subnet}"
-    }
-
-    if subnet == "mix":
-        if filetype in ['win', 'keenetic bat']:
-            mix_formatter = lambda ip: f"{ip.strip()} mask 255.255.255.0" if ip.endswith('.0') else f"{ip.strip()} mask 255.255.255.255"
-        elif filetype.lower() == 'ovpn':
-            mix_formatter = lambda ip: f"{ip.strip()} 255.255.255.0" if ip.endswith('.0') else f"{ip.strip()} 255.255.255.255"
-        else:
-            mix_formatter = lambda ip: f"{ip.strip()}/24" if ip.endswith('.0') else f"{ip.strip()}/32"
+    return filetype, gateway, ken_gateway, mk_list_name
 
-        formatters.update({
-            'win': lambda ip: f"route add {mix_formatter(ip)} {gateway}",
-            'unix': lambda ip: f"ip route {mix_formatter(ip)} {gateway}",
-            'keenetic bat': lambda ip: f"route add {mix_formatter(ip)} 0.0.0.0",
-            'keenetic cli': lambda ip: f"ip route {mix_formatter(ip)} {ken_gateway} auto !{comment(selected_service)}",
-            'cidr': lambda ip: f"{mix_formatter(ip)}",
-            'ovpn': lambda ip: f'push "route {mix_formatter(ip)}"',
-            'mikrotik': lambda ip: f'/ip/firewall/address-list add list={mk_list_name}' + (f' comment="{comment(selected_service)}"' if mk_comment != "off" else "") + f' address={mix_formatter(ip)}',
-            'wireguard': lambda ip: f"{mix_formatter(ip)}"
-        })
-
-    if filetype.lower() in formatters:
-        write_file(filename, ips, formatters[filetype.lower()])
+def process_file_format(filename, networks, prefixlens, filetype, gateway, selected_service, mk_list_name, mk_comment, subnet, ken_gateway,
+                        diff=False, state_file=None, networks6=(), prefixlens6=()):
+    filetype, gateway, ken_gateway, mk_list_name = format_input(
+        filetype, gateway, ken_gateway, mk_list_name, selected_service, mk_comment, subnet
+    )
 
-        if filetype.lower() == 'keenetic bat':
-            return split_file_by_lines(filename, max_lines=999)
+    output_format = OUTPUT_FORMATS.get(filetype.lower(), OUTPUT_FORMATS['ip'])
+    service_comment = comment(selected_service)
+    constants = {
+        'gateway': gateway,
+        'ken_gateway': ken_gateway,
+        'list_name': mk_list_name,
+        'comment': service_comment,
+        'mk_comment': f' comment="{service_comment}"' if mk_comment != "off" else ""
+    }
 
-    return False
+    with run_metrics.stage('format'):
+        add_template = output_format.exact if subnet == "collapse" and output_format.exact else output_format.add
+        families = [(networks, prefixlens, 32, compile_template(add_template, constants),
+                     compile_template(output_format.remove, constants), '')]
+        if output_format.add6 is not None:
+            families.append((networks6, prefixlens6, 128, compile_template(output_format.add6, constants, 128),
+                             compile_template(output_format.remove6, constants, 128), ':ipv6'))
+        elif len(networks6):
+            print(f"{yellow('IPv6 не поддерживается для формата')} {filetype}{yellow(', IPv6-адреса не сохранены.')}")
+
+        if diff and state_file and output_format.remove is not None:
+            state_key = f"{filetype.lower()}:{os.path.abspath(filename)}:{service_comment}"
+            changes = []
+            for family_networks, family_prefixlens, bits, family_formatter, remove_formatter, key_suffix in families:
+                published = load_published_prefixes(state_file, state_key + key_suffix, bits) or set()
+                current = set(zip(family_networks, family_prefixlens))
+                changes.append((bits, family_formatter, remove_formatter, sorted(current - published), sorted(published - current)))
+            print(f"{Style.BRIGHT}Изменения с прошлого запуска:{Style.RESET_ALL} добавлено {sum(len(change[3]) for change in changes)}, "
+                  f"удалено {sum(len(change[4]) for change in changes)}")
+            lines = (line for bits, family_formatter, remove_formatter, added, removed in changes
+                     for line in itertools.chain(
+                         (remove_formatter(int_to_ip(network, bits), prefixlen) for network, prefixlen in removed),
+                         (family_formatter(int_to_ip(network, bits), prefixlen) for network, prefixlen in added)))
+        else:
+            if diff:
+                print(f"{yellow('Режим изменений не поддерживается для формата')} {filetype or 'ip'}{yellow(', сохранен полный список.')}")
+            state_key = None
+            lines = (family_formatter(int_to_ip(network, bits), prefixlen)
+                     for family_networks, family_prefixlens, bits, family_formatter, _, _ in families
+                     for network, prefixlen in zip(family_networks, family_prefixlens))
+
+    with run_metrics.stage('write'):
+        with RouteFileWriter(filename, output_format.separator, output_format.terminator, output_format.max_lines) as writer:
+            writer.write_lines(lines)
+        file_was_split = writer.split
+
+    if state_key:
+        for family_networks, family_prefixlens, bits, _, _, key_suffix in families:
+            save_published_prefixes(state_file, state_key + key_suffix, family_networks, family_prefixlens, bits)
+    return file_was_split
 
 async def main():
     parser = argparse.ArgumentParser(description="DNS resolver script with custom config file.")
@@ -792,13 +2931,34 @@ async def main():
         default='config.ini',
         help='Путь к конфигурационному файлу (по умолчанию: config.ini)'
     )
+    parser.add_argument(
+        '--daemon',
+        action='store_true',
+        help='Работать постоянно: повторно разрешать DNS имена по истечении TTL и обновлять результат при изменениях'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Число процессов для разрешения DNS имен: список делится между ними, лимит запросов к DNS серверам общий'
+    )
     args = parser.parse_args()
 
     try:
         config_file = args.config
         (service, rate_limit, filename, cloudflare, filetype, gateway, run_command, 
          dns_server_indices, mk_list_name, subnet, ken_gateway, localplatform, 
-         localdns, mk_comment) = read_config(config_file)
+         localdns, mk_comment, concurrency, backend, cache, cache_min_ttl,
+         cache_refresh, exclude, max_routes, diff, daemon_min_interval,
+         daemon_rebuild_interval, ipv6, subnet6, adaptive, rate_limit_max, servers_per_domain,
+         servers_agreement, servers_audit, retries, retry_budget, hedge, negative_cache,
+         negative_max_days, negative_revalidate, report, prometheus) = read_config(config_file)
+        config_dir = os.path.dirname(os.path.abspath(config_file))
+        report = os.path.join(config_dir, report) if report else ''
+        prometheus = os.path.join(config_dir, prometheus) if prometheus else ''
+        ipv6 = ipv6 in ['yes', 'y']
+        subnet6 = subnet6 if subnet6 in {'48', '64', 'collapse'} else '128'
+        load_started = time.perf_counter()
 
         if localplatform in ['yes', 'y']:
             urls = await load_urls_from_file()
@@ -810,107 +2970,196 @@ async def main():
             with open('custom-dns-list.txt', 'r', encoding='utf-8') as file:
                 local_dns_names = [line.strip() for line in file if line.strip()]
 
-        selected_services = check_service_config(service, urls, local_dns_names)
-
         if localdns in ['yes', 'y']:
             dns_servers = await load_dns_from_file()
         else:
             dns_servers = await load_dns_servers(dns_db_url)
+        list_load_time = time.perf_counter() - load_started
 
+        selected_services = check_service_config(service, urls, local_dns_names)
         selected_dns_servers = check_dns_servers(dns_servers, dns_server_indices)
-
         include_cloudflare = check_include_cloudflare(cloudflare)
+
+        load_started = time.perf_counter()
         if include_cloudflare:
             cloudflare_ips = await get_cloudflare_ips()
         else:
-            cloudflare_ips = set()
+            cloudflare_ips = IPRangeSet()
+
+        excluded_ips = await load_exclusions(exclude) if exclude else IPRangeSet()
+        run_metrics.add_stage('list_load', list_load_time + time.perf_counter() - load_started)
 
-        unique_ips_all_services = set()
+        unique_ips_all_services = (set(), set())
 
         stats = {
             'null_ips_count': 0,
             'cloudflare_ips_count': 0,
+            'excluded_ips_count': 0,
             'total_domains_processed': 0,
-            'domain_errors': 0
+            'domain_errors': 0,
+            'nxdomain': 0,
+            'no_answer': 0,
+            'timeout': 0,
+            'servfail': 0
         }
 
-        total_domains = 0
-        for service_name in selected_services:
-            if service_name == 'Custom DNS list':
-                total_domains += len(local_dns_names)
-            else:
-                url_or_file = urls[service_name]
-                print(f"{Style.BRIGHT}Загрузка DNS имен платформы{Style.RESET_ALL} {service_name}...")
-                dns_names = await load_dns_names(url_or_file)
-                total_domains += len(dns_names)
-
-        domains_count = total_domains
-        total_domains *= len(selected_dns_servers)
-        stats['total_domains'] = total_domains
+        stats['total_domains'] = 0
         stats['start_time'] = time.time()
 
-        print(f"{Style.BRIGHT}Загружено {domains_count} DNS имен.{Style.RESET_ALL}\n{yellow('Резолвинг...')}")
+        print(f"{Style.BRIGHT}Загрузка DNS имен платформ:{Style.RESET_ALL} {len(selected_services)}\n{yellow('Резолвинг...')}")
 
         progress_tracker = ProgressTracker(
-            total=total_domains,
+            total=0,
             stats=stats,
             unique_ips_set=unique_ips_all_services,
-            num_dns_servers=len(selected_dns_servers),
+            num_dns_servers=min(servers_per_domain or len(selected_dns_servers), len(selected_dns_servers)),
             rate_limit=rate_limit,
-            domains_count=domains_count
+            history=load_throughput_history(report)
         )
-        progress_tracker.start()
-
-        stats_lock = asyncio.Lock()
 
         periodic_updater = PeriodicProgressUpdater(progress_tracker, stats)
         await periodic_updater.start()
 
-        tasks = []
-
-        for service_name in selected_services:
-            if service_name == 'Custom DNS list':
-                tasks.append(resolve_dns_with_workers(
-                    service_name, local_dns_names, selected_dns_servers,
-                    cloudflare_ips, unique_ips_all_services,
-                    stats, include_cloudflare, rate_limit,
-                    stats_lock
-                ))
+        registry = DomainRegistry()
+        coordinator = None
+        if 0 < servers_per_domain < len(selected_dns_servers):
+            coordinator = SubsetCoordinator(servers_per_domain, servers_agreement, servers_audit, progress_tracker)
+        retry_policy = RetryPolicy(retries, retry_budget, hedge) if retries or hedge else None
+        dns_backend = create_dns_backend(backend)
+
+        answer_cache = None
+        if cache in ['yes', 'y']:
+            answer_cache = AnswerCache(
+                os.path.join(config_dir, 'dns-cache.sqlite'),
+                cache_min_ttl, cache_refresh in ['yes', 'y']
+            )
+            answer_cache.open()
+            progress_tracker.cache = answer_cache
+        elif args.daemon:
+            answer_cache = AnswerCache(None)
+
+        negative = None
+        if negative_cache in ['yes', 'y']:
+            negative = NegativeCache(
+                os.path.join(config_dir, 'dns-cache.sqlite'),
+                max_ttl=int(negative_max_days * 86400), revalidate=negative_revalidate
+            )
+            negative.open()
+
+        scheduler = ResolveScheduler(registry, daemon_min_interval) if args.daemon else None
+        if args.daemon and args.workers > 1:
+            print(f"{yellow('Режим демона работает в одном процессе, --workers не используется.')}")
+        shards = args.workers if args.workers > 1 and scheduler is None else 1
+        adaptive_max_rate = (rate_limit_max or rate_limit) if adaptive in ['yes', 'y'] else 0
+        rate_summary = None
+
+        resolve_started = time.perf_counter()
+        try:
+            if shards > 1:
+                job = ShardJob(
+                    0, [], selected_dns_servers, progress_tracker.num_dns_servers, rate_limit / shards,
+                    max(1, math.ceil(concurrency / shards)), backend, ipv6, adaptive_max_rate / shards,
+                    answer_cache.path if answer_cache is not None else None, cache_min_ttl,
+                    cache_refresh in ['yes', 'y'], negative.path if negative is not None else None,
+                    negative.max_ttl if negative is not None else 0, negative_revalidate,
+                    servers_per_domain, servers_agreement, servers_audit, retries, retry_budget, hedge
+                )
+                rate_summary = await resolve_dns_sharded(
+                    stream_dns_names(selected_services, urls, local_dns_names), job, shards, registry,
+                    stats, progress_tracker,
+                    {'retry': retry_policy, 'negative': negative, 'cache': answer_cache, 'coordinator': coordinator}
+                )
+                workers = []
             else:
-                url_or_file = urls[service_name]
-                dns_names = await load_dns_names(url_or_file)
-                if dns_names:
-                    tasks.append(resolve_dns_with_workers(
-                        service_name, dns_names, selected_dns_servers,
-                        cloudflare_ips, unique_ips_all_services,
-                        stats, include_cloudflare, rate_limit,
-                        stats_lock
-                    ))
-
-        if tasks:
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-
-            with open(filename, 'w', encoding='utf-8') as file:
-                for result in results:
-                    if isinstance(result, str) and result.strip():
-                        file.write(result)
-        else:
-            with open(filename, 'w', encoding='utf-8') as file:
-                pass
+                workers = await resolve_dns_with_workers(
+                    stream_dns_names(selected_services, urls, local_dns_names),
+                    selected_dns_servers, registry, stats, rate_limit, concurrency,
+                    dns_backend, progress_tracker, answer_cache,
+                    scheduler.on_answer if scheduler else None, ipv6, adaptive_max_rate, coordinator,
+                    retry_policy, negative
+                )
+        except BaseException:
+            await close_resolution(dns_backend, answer_cache, negative=negative)
+            raise
+        if scheduler is None:
+            await close_resolution(dns_backend, answer_cache, negative=negative)
+        run_metrics.add_stage('resolve', time.perf_counter() - resolve_started)
+
+        tqdm.write(f"{Style.BRIGHT}Загружено {progress_tracker.domains_count} уникальных DNS имен.{Style.RESET_ALL}")
+
+        with run_metrics.stage('filter'):
+            addresses, addresses6 = collect_addresses(
+                selected_services, registry, selected_dns_servers, cloudflare_ips,
+                unique_ips_all_services, stats, include_cloudflare, excluded_ips
+            )
 
         await periodic_updater.stop()
         progress_tracker.close()
 
         print(f"{Style.BRIGHT}Использовались DNS серверы:{Style.RESET_ALL} " + ', '.join(
             [pair[0] for pair in selected_dns_servers]))
+        print_rate_limiter_stats(rate_summary)
+        if retry_policy is not None:
+            retry_policy.print_stats()
+        if negative is not None:
+            negative.print_stats()
+        if coordinator is not None:
+            coordinator.print_stats(len(selected_dns_servers))
+        print_cname_targets(registry, selected_services)
 
         print(f"\n{yellow('Обработка результатов...')}")
 
-        subnet = subnet_input(subnet)
-        if subnet != '32':
-            group_ips_in_subnets_optimized(filename, subnet)
+        subnet, max_routes = subnet_input(subnet, max_routes)
+        state_file = os.path.join(config_dir, 'domain-mapper-state.json')
+
+        if scheduler is not None:
+            filetype, gateway, ken_gateway, mk_list_name = format_input(
+                filetype, gateway, ken_gateway, mk_list_name, selected_services, mk_comment, subnet
+            )
+            published = None
+
+            async def rebuild():
+                nonlocal published
+                unique_ips = (set(), set())
+                progress_tracker.collect_stats()
+                rebuild_stats = dict(stats)
+                with run_metrics.stage('filter'):
+                    addresses, addresses6 = collect_addresses(
+                        selected_services, registry, selected_dns_servers, cloudflare_ips,
+                        unique_ips, rebuild_stats, include_cloudflare, excluded_ips
+                    )
+                with run_metrics.stage('aggregate'):
+                    networks, prefixlens, networks6, prefixlens6 = group_ip_families(
+                        addresses, addresses6, subnet, subnet6, max_routes)
+                prefixes = (set(zip(networks, prefixlens)), set(zip(networks6, prefixlens6)))
+                if prefixes == published:
+                    return
+                process_file_format(
+                    filename, networks, prefixlens, filetype, gateway, selected_services, mk_list_name, mk_comment,
+                    subnet, ken_gateway, diff in ['yes', 'y'], state_file, networks6, prefixlens6
+                )
+                published = prefixes
+                print(f"{Style.BRIGHT}{time.strftime('%H:%M:%S')} Результат обновлен:{Style.RESET_ALL} {len(networks) + len(networks6)} записей в {filename}")
+                run_metrics.write(report, prometheus, rebuild_stats, len(unique_ips[0]) + len(unique_ips[1]))
+                if run_command:
+                    await asyncio.to_thread(os.system, run_command)
+
+            print(f"\n{yellow('Режим демона: DNS имена разрешаются повторно по истечении TTL (Ctrl+C - выход)')}")
+            try:
+                await run_daemon(scheduler, rebuild, daemon_rebuild_interval, answer_cache, negative)
+            finally:
+                await close_resolution(dns_backend, answer_cache, workers, negative)
+
+        with run_metrics.stage('aggregate'):
+            networks, prefixlens, networks6, prefixlens6 = group_ip_families(
+                addresses, addresses6, subnet, subnet6, max_routes)
 
-        file_was_split = process_file_format(filename, filetype, gateway, selected_services, mk_list_name, mk_comment, subnet, ken_gateway)
+        file_was_split = process_file_format(
+            filename, networks, prefixlens, filetype, gateway, selected_services, mk_list_name, mk_comment, subnet, ken_gateway,
+            diff in ['yes', 'y'], state_file, networks6, prefixlens6
+        )
+        run_metrics.print_stages()
+        run_metrics.write(report, prometheus, stats, sum(map(len, unique_ips_all_services)), rate_summary)
 
         if run_command:
             print("\nВыполнение команды после завершения скрипта...")
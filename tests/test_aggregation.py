@@ -0,0 +1,57 @@
+import contextlib
+import io
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main as domain_mapper
+
+
+class RouteBudgetTest(unittest.TestCase):
+    def group(self, addresses, addresses6, max_routes, subnet6='collapse'):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return domain_mapper.group_ip_families(addresses, addresses6, 'collapse', subnet6, max_routes)
+
+    def test_budget_is_shared_between_families(self):
+        rng = random.Random(3)
+        addresses = [rng.randrange(1 << 32) for _ in range(3000)]
+        addresses6 = [rng.randrange(1 << 128) for _ in range(1000)]
+        networks, _, networks6, _ = self.group(addresses, addresses6, 500)
+        self.assertLessEqual(len(networks) + len(networks6), 500)
+        self.assertTrue(networks)
+        self.assertTrue(networks6)
+
+    def test_ipv4_only_gets_whole_budget(self):
+        rng = random.Random(4)
+        addresses = [rng.randrange(1 << 32) for _ in range(3000)]
+        networks, _, networks6, _ = self.group(addresses, [], 500)
+        self.assertLessEqual(len(networks), 500)
+        self.assertGreater(len(networks), 450)
+        self.assertFalse(networks6)
+
+    def test_fixed_ipv6_prefix_counts_against_budget(self):
+        rng = random.Random(5)
+        addresses = [rng.randrange(1 << 32) for _ in range(3000)]
+        for count in (1, 40, 200):
+            addresses6 = [rng.randrange(1 << 64) << 64 for _ in range(count)]
+            networks, _, networks6, prefixlens6 = self.group(addresses, addresses6, 500, '64')
+            self.assertEqual(len(networks6), count)
+            self.assertEqual(set(prefixlens6), {64})
+            self.assertLessEqual(len(networks) + len(networks6), 500)
+            self.assertGreaterEqual(len(networks) + len(networks6), 495)
+
+    def test_ipv4_takes_budget_ipv6_does_not_need(self):
+        rng = random.Random(6)
+        addresses = [rng.randrange(1 << 32) for _ in range(3000)]
+        addresses6 = [(0x20010db8 << 96) | index for index in range(1000)]
+        networks, _, networks6, _ = self.group(addresses, addresses6, 500)
+        self.assertLessEqual(len(networks6), 16)
+        self.assertLessEqual(len(networks) + len(networks6), 500)
+        self.assertGreaterEqual(len(networks) + len(networks6), 495)
+
+
+if __name__ == '__main__':
+    unittest.main()
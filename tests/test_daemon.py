@@ -0,0 +1,65 @@
+import asyncio
+import os
+import sys
+import unittest
+
+import dns.resolver
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main as domain_mapper
+
+
+class ScriptedBackend:
+    def __init__(self, results):
+        self.results = list(results)
+
+    async def resolve(self, domain, nameservers, rdtype=domain_mapper.DNS_TYPE_A, timeout=None):
+        result = self.results.pop(0)
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    async def close(self):
+        pass
+
+
+class StaleAnswerTest(unittest.TestCase):
+    def rebuild(self, registry, servers):
+        addresses, _ = domain_mapper.collect_addresses(
+            ['Service'], registry, servers, domain_mapper.IPRangeSet(), (set(), set()),
+            {'null_ips_count': 0}, False)
+        return sorted(domain_mapper.int_to_ip(value) for value in addresses)
+
+    def run_sequence(self, results):
+        servers = [('Single', ['192.0.2.53'])]
+        registry = domain_mapper.DomainRegistry()
+        registry.register('Service', ['gone.example.com', 'kept.example.com'])
+        scheduler = domain_mapper.ResolveScheduler(registry)
+        backend = ScriptedBackend([domain_mapper.DNSAnswer(['198.51.100.1'], 300),
+                                   domain_mapper.DNSAnswer(['198.51.100.2'], 300)] + results)
+        worker = domain_mapper.DNSServerWorker('Single', servers[0][1], 1000, 1, backend)
+
+        async def resolve(domain):
+            scheduler.on_answer(worker, domain, await worker.process_single_domain(domain))
+
+        asyncio.run(resolve('gone.example.com'))
+        asyncio.run(resolve('kept.example.com'))
+        self.assertEqual(self.rebuild(registry, servers), ['198.51.100.1', '198.51.100.2'])
+        scheduler.changed = False
+        asyncio.run(resolve('gone.example.com'))
+        return scheduler, self.rebuild(registry, servers)
+
+    def test_nxdomain_removes_addresses(self):
+        scheduler, addresses = self.run_sequence([dns.resolver.NXDOMAIN()])
+        self.assertTrue(scheduler.changed)
+        self.assertEqual(addresses, ['198.51.100.2'])
+
+    def test_timeout_keeps_addresses(self):
+        scheduler, addresses = self.run_sequence([dns.resolver.Timeout()])
+        self.assertFalse(scheduler.changed)
+        self.assertEqual(addresses, ['198.51.100.1', '198.51.100.2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import os
+import random
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'utilities'))
+
+import convert
+import main as domain_mapper
+
+
+class IPRangeSetSyncTest(unittest.TestCase):
+    networks = ['103.21.244.0/22', '104.16.0.0/13', '104.24.0.0/14', '172.64.0.0/13',
+                '173.245.48.0/20', '10.0.0.0/8', '10.1.0.0/16', '11.0.0.0/8', 'junk', '2606:4700::/32']
+
+    def test_copies_agree_on_ipv4(self):
+        ours = domain_mapper.IPRangeSet(self.networks)
+        theirs = convert.IPRangeSet(self.networks)
+        self.assertEqual(list(ours.starts), list(theirs.starts))
+        self.assertEqual(list(ours.ends), list(theirs.ends))
+        rng = random.Random(7)
+        for _ in range(5000):
+            ip = f"{rng.choice([10, 11, 12, 103, 104, 172, 173])}.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}"
+            self.assertEqual(ip in ours, ip in theirs, ip)
+        for value in ('', 'not an ip', None, '10.0.0'):
+            self.assertEqual(value in ours, value in theirs)
+
+    def test_ipv6_is_main_only(self):
+        self.assertIn('2606:4700::1', domain_mapper.IPRangeSet(self.networks))
+        self.assertNotIn('2606:4700::1', convert.IPRangeSet(self.networks))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main as domain_mapper
+
+
+class NegativeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = domain_mapper.NegativeCache(None, revalidate=0.0)
+
+    def test_single_timeout_does_not_skip(self):
+        self.cache.record_failure('example.com', 'ns', transient=True)
+        self.assertFalse(self.cache.skip('example.com', 'ns'))
+
+    def test_consecutive_timeouts_skip(self):
+        for _ in range(self.cache.min_failures - 1):
+            self.cache.record_failure('example.com', 'ns', transient=True)
+            self.assertFalse(self.cache.skip('example.com', 'ns'))
+        self.cache.record_failure('example.com', 'ns', transient=True)
+        self.assertTrue(self.cache.skip('example.com', 'ns'))
+
+    def test_success_resets_failures(self):
+        for _ in range(self.cache.min_failures - 1):
+            self.cache.record_failure('example.com', 'ns', transient=True)
+        self.cache.record_success('example.com', 'ns')
+        self.cache.record_failure('example.com', 'ns', transient=True)
+        self.assertFalse(self.cache.skip('example.com', 'ns'))
+
+    def test_nxdomain_skips_for_negative_ttl(self):
+        self.cache.record_failure('missing.example.com', 'ns', 600)
+        self.assertTrue(self.cache.skip('missing.example.com', 'ns'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main as domain_mapper
+
+
+class MeasuredRateTest(unittest.TestCase):
+    def setUp(self):
+        self.tracker = domain_mapper.ProgressTracker(100, {}, (set(), set()), display=False)
+
+    def test_too_few_samples(self):
+        self.tracker.measured_rate('ns', 0, 0.0)
+        self.assertIsNone(self.tracker.measured_rate('ns', 10, 2.0))
+
+    def test_steady_progress(self):
+        self.tracker.measured_rate('ns', 0, 0.0)
+        self.assertAlmostEqual(self.tracker.measured_rate('ns', 100, 10.0), 10.0)
+
+    def test_stalled_group_is_near_zero(self):
+        for second in range(0, 40, 2):
+            rate = self.tracker.measured_rate('ns', 50, float(second))
+        self.assertEqual(rate, domain_mapper.MIN_THROUGHPUT)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import asyncio
+import os
+import sys
+import unittest
+
+import dns.resolver
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main as domain_mapper
+
+
+class FlakyBackend:
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.calls = 0
+
+    async def resolve(self, domain, nameservers, rdtype=domain_mapper.DNS_TYPE_A, timeout=None):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise dns.resolver.Timeout()
+        return domain_mapper.DNSAnswer(['192.0.2.1'], 300)
+
+    async def close(self):
+        pass
+
+
+class RetryWithoutAdaptiveTest(unittest.TestCase):
+    def resolve(self, failures: int, retries: int = 2):
+        backend = FlakyBackend(failures)
+        retry = domain_mapper.RetryPolicy(retries, 0.1, 0, base_delay=0.0)
+        worker = domain_mapper.DNSServerWorker('Single', ['192.0.2.53'], 1000, 1, backend, retry=retry)
+        answer = asyncio.run(worker.process_single_domain('example.com'))
+        return answer, worker, backend, retry
+
+    def test_single_server_group_retries_after_timeout(self):
+        answer, worker, backend, retry = self.resolve(failures=1)
+        self.assertEqual(answer.addresses, ['192.0.2.1'])
+        self.assertEqual(backend.calls, 2)
+        self.assertEqual(retry.retried, 1)
+        self.assertEqual(worker.stats['ok'], 1)
+        self.assertEqual(worker.stats['error'], 0)
+
+    def test_exhausted_retries_are_counted_as_timeout(self):
+        answer, worker, backend, retry = self.resolve(failures=5)
+        self.assertEqual(answer, domain_mapper.NO_ANSWER)
+        self.assertEqual(backend.calls, 3)
+        self.assertEqual(retry.retried, 2)
+        self.assertEqual(worker.stats['timeout'], 1)
+        self.assertEqual(worker.stats['error'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main as domain_mapper
+
+
+class RouteFileWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.filename = os.path.join(self.directory.name, 'routes.bat')
+
+    def read(self, path):
+        with open(path, 'r', encoding='utf-8') as file:
+            return file.read()
+
+    def test_single_file_uses_terminator(self):
+        with domain_mapper.RouteFileWriter(self.filename, '\n', '\n', 5) as writer:
+            writer.write_lines(['a', 'b'])
+        self.assertEqual(self.read(self.filename), 'a\nb\n')
+
+    def test_last_split_part_has_no_trailing_newline(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            with domain_mapper.RouteFileWriter(self.filename, '\n', '', 2) as writer:
+                writer.write_lines(['a', 'b', 'c', 'd', 'e'])
+        parts = [os.path.join(self.directory.name, f'routes_p{part}.bat') for part in (1, 2, 3)]
+        self.assertEqual([self.read(path) for path in parts], ['a\nb\n', 'c\nd\n', 'e'])
+        self.assertFalse(os.path.exists(self.filename))
+
+
+if __name__ == '__main__':
+    unittest.main()
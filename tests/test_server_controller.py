@@ -0,0 +1,39 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main as domain_mapper
+
+
+class ServerControllerTest(unittest.TestCase):
+    def setUp(self):
+        self.controller = domain_mapper.ServerController(domain_mapper.RateLimiter(100), 200, base_timeout=2.0)
+
+    def test_burst_of_timeouts_backs_off_once(self):
+        started = time.monotonic()
+        for _ in range(20):
+            self.controller.record_failure(started)
+        self.assertEqual(self.controller.failures, 20)
+        self.assertLessEqual(self.controller.backoff, 2.0)
+        self.assertFalse(self.controller.available)
+
+    def test_backoff_grows_across_windows(self):
+        for expected in (1.0, 2.0, 4.0):
+            self.controller.backoff_until = 0.0
+            started = time.monotonic()
+            for _ in range(5):
+                self.controller.record_failure(started)
+            self.assertEqual(self.controller.backoff, expected)
+
+    def test_timeout_grows_past_base_up_to_limit(self):
+        for _ in range(20):
+            self.controller.record_failure()
+        self.assertGreater(self.controller.timeout, self.controller.base_timeout)
+        self.assertEqual(self.controller.timeout, self.controller.max_timeout)
+
+
+if __name__ == '__main__':
+    unittest.main()
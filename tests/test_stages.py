@@ -0,0 +1,37 @@
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main as domain_mapper
+
+
+class DownloadStageTest(unittest.TestCase):
+    def test_download_excludes_consumer_time(self):
+        with tempfile.TemporaryDirectory() as directory:
+            urls = {}
+            for name in ('First', 'Second', 'Third'):
+                urls[name] = os.path.join(directory, name)
+                with open(urls[name], 'w', encoding='utf-8') as file:
+                    file.write('example.com\n')
+
+            async def consume():
+                loaded = []
+                async for service, dns_names in domain_mapper.stream_dns_names(list(urls), urls, []):
+                    loaded.append(service)
+                    await asyncio.sleep(0.2)
+                return loaded
+
+            metrics = domain_mapper.RunMetrics()
+            with mock.patch.object(domain_mapper, 'run_metrics', metrics):
+                loaded = asyncio.run(consume())
+        self.assertEqual(sorted(loaded), sorted(urls))
+        self.assertLess(metrics.stages['download'], 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,371 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from array import array
+from typing import Dict, List, NamedTuple, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main as domain_mapper
+from colorama import Style
+
+DNS_FLAG_RESPONSE = 0x8400
+DNS_FLAG_RECURSION = 0x0100
+DNS_FLAG_TRUNCATED = 0x0200
+DNS_RCODE_SERVFAIL = 2
+DNS_RCODE_NXDOMAIN = 3
+DNS_TYPE_SOA = 6
+DNS_SOA_RDATA = b'\x00\x00' + struct.pack('!IIIII', 1, 3600, 600, 86400, 300)
+
+SUBNET_MODES = ['no', '24', '16', 'mix', 'collapse']
+FILE_FORMATS = ['ip', 'cidr', 'unix', 'win', 'keenetic bat', 'keenetic cli', 'mikrotik', 'ovpn', 'wireguard']
+
+class StubSettings(NamedTuple):
+    latency: float
+    jitter: float
+    loss: float
+    servfail: float
+    nxdomain: float
+    answers: int
+    ttl: int
+    seed: int
+
+def stub_address(name_hash: int, index: int, rdtype: int) -> bytes:
+    if rdtype == domain_mapper.DNS_TYPE_A:
+        return struct.pack('!I', 0x0B000000 + (name_hash * 31 + index * 7919) % 0xD0000000)
+    return b'\x20\x01\x0d\xb8' + ((name_hash << 32) | index).to_bytes(12, 'big')
+
+def stub_response(query: bytes, settings: StubSettings, rng: random.Random, udp: bool) -> Optional[bytes]:
+    if len(query) < 17:
+        return None
+    query_id, flags, qdcount, _, _, arcount = struct.unpack_from('!HHHHHH', query)
+    if qdcount != 1:
+        return None
+    offset = 12
+    while query[offset]:
+        offset += query[offset] + 1
+        if offset >= len(query):
+            return None
+    offset += 1
+    qname = query[12:offset].lower()
+    rdtype = struct.unpack_from('!H', query, offset)[0]
+    question = query[12:offset + 4]
+    name_hash = zlib.crc32(qname)
+
+    if rng.random() < settings.servfail:
+        rcode = DNS_RCODE_SERVFAIL
+    elif name_hash % 10000 < settings.nxdomain * 10000:
+        rcode = DNS_RCODE_NXDOMAIN
+    else:
+        rcode = 0
+
+    records = b''
+    ancount = nscount = 0
+    if rcode == DNS_RCODE_NXDOMAIN:
+        records = b'\xc0\x0c' + struct.pack('!HHIH', DNS_TYPE_SOA, 1, settings.ttl, len(DNS_SOA_RDATA)) + DNS_SOA_RDATA
+        nscount = 1
+    elif rcode == 0 and rdtype in (domain_mapper.DNS_TYPE_A, domain_mapper.DNS_TYPE_AAAA):
+        size = 4 if rdtype == domain_mapper.DNS_TYPE_A else 16
+        records = b''.join(b'\xc0\x0c' + struct.pack('!HHIH', rdtype, 1, settings.ttl, size)
+                           + stub_address(name_hash, index, rdtype) for index in range(settings.answers))
+        ancount = settings.answers
+
+    flags = DNS_FLAG_RESPONSE | (flags & DNS_FLAG_RECURSION) | rcode
+    if udp and 12 + len(question) + len(records) > (1232 if arcount else 512):
+        flags |= DNS_FLAG_TRUNCATED
+        records = b''
+        ancount = nscount = 0
+    return struct.pack('!HHHHHH', query_id, flags, 1, ancount, nscount, 0) + question + records
+
+def stub_delay(settings: StubSettings, rng: random.Random) -> float:
+    return max(0.0, settings.latency + rng.uniform(-settings.jitter, settings.jitter))
+
+class StubUDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, settings: StubSettings, rng: random.Random):
+        self.settings = settings
+        self.rng = rng
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        if self.rng.random() < self.settings.loss:
+            return
+        response = stub_response(data, self.settings, self.rng, True)
+        if response is None:
+            return
+        delay = stub_delay(self.settings, self.rng)
+        if delay:
+            asyncio.get_running_loop().call_later(delay, self.transport.sendto, response, addr)
+        else:
+            self.transport.sendto(response, addr)
+
+async def serve_stub(settings: StubSettings, connection):
+    rng = random.Random(settings.seed)
+    loop = asyncio.get_running_loop()
+
+    async def handle_tcp(reader, writer):
+        try:
+            while True:
+                length = int.from_bytes(await reader.readexactly(2), 'big')
+                response = stub_response(await reader.readexactly(length), settings, rng, False)
+                if response is None:
+                    break
+                await asyncio.sleep(stub_delay(settings, rng))
+                writer.write(len(response).to_bytes(2, 'big') + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    for _ in range(20):
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: StubUDPProtocol(settings, rng), local_addr=('127.0.0.1', 0))
+        port = transport.get_extra_info('sockname')[1]
+        try:
+            server = await asyncio.start_server(handle_tcp, '127.0.0.1', port, backlog=4096)
+            break
+        except OSError:
+            transport.close()
+    else:
+        raise OSError("не удалось занять порт для тестового DNS сервера")
+
+    connection.send(port)
+    async with server:
+        await server.serve_forever()
+
+def run_stub(settings: StubSettings, connection):
+    asyncio.run(serve_stub(settings, connection))
+
+def start_stub(settings: StubSettings):
+    context = multiprocessing.get_context('spawn')
+    parent, child = context.Pipe()
+    process = context.Process(target=run_stub, args=(settings, child), daemon=True)
+    process.start()
+    if not parent.poll(30):
+        process.terminate()
+        raise RuntimeError("тестовый DNS сервер не запустился")
+    return process, parent.recv()
+
+class TimedBackend:
+    def __init__(self, backend):
+        self.backend = backend
+        self.latencies = array('d')
+
+    async def resolve(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await self.backend.resolve(*args, **kwargs)
+        finally:
+            self.latencies.append(time.perf_counter() - started)
+
+    async def close(self):
+        await self.backend.close()
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(usage / (1 << 20) if sys.platform == 'darwin' else usage / 1024, 1)
+
+def git_commit() -> Optional[str]:
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+def load_corpus(directory: str, limit: int = 0) -> List[str]:
+    domains = {}
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), 'r', encoding='utf-8', errors='ignore') as file:
+            for line in file:
+                domain = domain_mapper.normalize_domain(line)
+                if domain and not domain.startswith('#'):
+                    domains[domain] = None
+    domains = list(domains)
+    return domains[:limit] if limit else domains
+
+def synthetic_addresses(count: int, seed: int) -> array:
+    rng = random.Random(seed)
+    blocks = [rng.randrange(0x0B00, 0xDF00) for _ in range(max(1, count // 200))]
+    addresses = set()
+    while len(addresses) < count:
+        addresses.add((rng.choice(blocks) << 16) | rng.randrange(1 << 16))
+    return array('I', sorted(addresses))
+
+async def bench_resolve(domains: List[str], port: int, args) -> Dict:
+    backend = TimedBackend(domain_mapper.DNS_BACKENDS[args.backend](
+        timeout=args.timeout, lifetime=args.timeout * 2, port=port))
+    stats = {'total_domains_processed': 0, 'domain_errors': 0, 'nxdomain': 0, 'no_answer': 0}
+    tracker = domain_mapper.ProgressTracker(0, stats, (set(), set()), display=False)
+    registry = domain_mapper.DomainRegistry()
+    retry = domain_mapper.RetryPolicy(args.retries, 0.1, 0) if args.retries else None
+
+    async def dns_lists():
+        yield 'Benchmark', domains
+
+    started = time.perf_counter()
+    try:
+        await domain_mapper.resolve_dns_with_workers(
+            dns_lists(), [('Stub', ['127.0.0.1'])], registry, stats, args.rate_limit, args.concurrency,
+            backend, tracker, ipv6=args.ipv6, adaptive_max_rate=args.rate_limit if args.adaptive else 0,
+            retry=retry
+        )
+    finally:
+        await backend.close()
+    elapsed = time.perf_counter() - started
+
+    return {
+        'seconds': round(elapsed, 3),
+        'domains': len(domains),
+        'queries': len(backend.latencies),
+        'qps': round(len(backend.latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(backend.latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(backend.latencies, 0.99) * 1000, 2),
+        'resolved': len(registry.answers),
+        'errors': stats['domain_errors'],
+        'timeout': stats['timeout'],
+        'servfail': stats['servfail'],
+        'nxdomain': stats['nxdomain'],
+        'no_answer': stats['no_answer'],
+        'retried': retry.retried if retry is not None else 0,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+def bench_postprocess(sizes: List[int], subnets: List[str], formats: List[str], seed: int) -> Dict[str, Dict]:
+    stages = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            started = time.perf_counter()
+            addresses = synthetic_addresses(size, seed)
+            stages[f'generate:{size}'] = {'seconds': round(time.perf_counter() - started, 3)}
+
+            grouped = None
+            for subnet in subnets:
+                started = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    networks, prefixlens = domain_mapper.group_ips_in_subnets_optimized(addresses, subnet)
+                stages[f'aggregate:{size}:{subnet}'] = {
+                    'seconds': round(time.perf_counter() - started, 3),
+                    'routes': len(networks),
+                    'peak_rss_mb': peak_rss_mb()
+                }
+                if grouped is None or subnet == '24':
+                    grouped = (networks, prefixlens, subnet)
+
+            networks, prefixlens, subnet = grouped
+            for filetype in formats:
+                filename = os.path.join(directory, f"{filetype.replace(' ', '-')}-{size}.txt")
+                started = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    domain_mapper.process_file_format(
+                        filename, networks, prefixlens, filetype, '10.0.0.1', ['Benchmark'], 'Benchmark',
+                        'on', subnet, '10.0.0.1 Wireguard0'
+                    )
+                stages[f'format:{size}:{filetype}'] = {
+                    'seconds': round(time.perf_counter() - started, 3),
+                    'routes': len(networks),
+                    'peak_rss_mb': peak_rss_mb()
+                }
+    return stages
+
+def parse_list(value: str, cast=str) -> List:
+    return [cast(item.strip()) for item in value.split(',') if item.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест Domain Mapper на локальном DNS сервере без доступа в сеть.")
+    parser.add_argument('--corpus', default=os.path.join(ROOT, 'platforms'),
+                        help='Каталог со списками DNS имен (по умолчанию: platforms)')
+    parser.add_argument('--domains', type=int, default=0, help='Сколько DNS имен взять из списков (0 - все)')
+    parser.add_argument('--backend', default='resolver', choices=sorted(domain_mapper.DNS_BACKENDS),
+                        help='Механизм разрешения DNS')
+    parser.add_argument('--rate-limit', type=int, default=5000, help='Лимит запросов к DNS серверу (запросов/сек)')
+    parser.add_argument('--concurrency', type=int, default=500, help='Одновременных запросов к DNS серверу')
+    parser.add_argument('--timeout', type=float, default=2.0, help='Таймаут одного запроса (сек)')
+    parser.add_argument('--retries', type=int, default=2, help='Повторов запроса при таймауте (0 - без повторов)')
+    parser.add_argument('--adaptive', action='store_true', help='Включить адаптивный лимит и таймауты')
+    parser.add_argument('--ipv6', action='store_true', help='Запрашивать и AAAA записи')
+    parser.add_argument('--latency', type=float, default=20.0, help='Задержка ответа тестового DNS сервера (мс)')
+    parser.add_argument('--jitter', type=float, default=10.0, help='Разброс задержки (± мс)')
+    parser.add_argument('--loss', type=float, default=0.0, help='Доля потерянных UDP запросов (0.01 = 1%%)')
+    parser.add_argument('--servfail', type=float, default=0.0, help='Доля ответов SERVFAIL')
+    parser.add_argument('--nxdomain', type=float, default=0.1, help='Доля несуществующих DNS имен')
+    parser.add_argument('--answers', type=int, default=4, help='Число адресов в ответе (больше ~75 - ответ через TCP)')
+    parser.add_argument('--sizes', default='10000,100000,1000000',
+                        help='Размеры синтетических наборов IP-адресов для агрегации и форматирования')
+    parser.add_argument('--subnets', default=','.join(SUBNET_MODES), help='Режимы агрегации через запятую')
+    parser.add_argument('--formats', default=','.join(FILE_FORMATS), help='Форматы сохранения через запятую')
+    parser.add_argument('--skip-resolve', action='store_true', help='Не выполнять тест разрешения DNS имен')
+    parser.add_argument('--seed', type=int, default=1, help='Начальное значение генератора случайных данных')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='Файл отчета в формате JSON (- для вывода на экран)')
+    args = parser.parse_args()
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'settings': vars(args),
+        'stages': {}
+    }
+
+    if not args.skip_resolve:
+        started = time.perf_counter()
+        domains = load_corpus(args.corpus, args.domains)
+        report['stages']['corpus'] = {'seconds': round(time.perf_counter() - started, 3), 'domains': len(domains)}
+
+        settings = StubSettings(args.latency / 1000, args.jitter / 1000, args.loss, args.servfail, args.nxdomain,
+                                args.answers, 300, args.seed)
+        process, port = start_stub(settings)
+        try:
+            report['stages']['resolve'] = asyncio.run(bench_resolve(domains, port, args))
+        finally:
+            process.terminate()
+            process.join()
+        resolve = report['stages']['resolve']
+        print(f"{Style.BRIGHT}Разрешение DNS имен:{Style.RESET_ALL} {resolve['domains']} имен за {resolve['seconds']} сек, "
+              f"{resolve['qps']} запр/сек, p50 {resolve['p50_ms']} мс, p99 {resolve['p99_ms']} мс")
+
+    report['stages'].update(bench_postprocess(parse_list(args.sizes, int), parse_list(args.subnets),
+                                              parse_list(args.formats), args.seed))
+    for name, stage in report['stages'].items():
+        if name.startswith(('aggregate:', 'format:')):
+            print(f"{Style.BRIGHT}{name}:{Style.RESET_ALL} {stage['seconds']} сек, маршрутов {stage['routes']}")
+    report['peak_rss_mb'] = peak_rss_mb()
+    print(f"{Style.BRIGHT}Пиковое потребление памяти:{Style.RESET_ALL} {report['peak_rss_mb']} МБ")
+
+    content = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output == '-':
+        print(content)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(content + '\n')
+        print(f"{Style.BRIGHT}Отчет сохранен в файл:{Style.RESET_ALL} {args.output}")
+
+
+if __name__ == "__main__":
+    main()
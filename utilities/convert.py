@@ -1,7 +1,11 @@
 import asyncio
+import bisect
 import ipaddress
+import itertools
 import os
 import re
+import socket
+from array import array
 from collections import defaultdict
 
 import httpx
@@ -47,26 +51,64 @@ def ken_gateway_input(ken_gateway):
     else:
         return ken_gateway
 
+def ip_to_int(ip: str) -> int:
+    return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+
+class IPRangeSet:
+    def __init__(self, networks=()):
+        self.starts = array('I')
+        self.ends = array('I')
+        self.update(networks)
+
+    def update(self, networks):
+        ranges = list(zip(self.starts, self.ends))
+        for network in networks:
+            if not isinstance(network, ipaddress.IPv4Network):
+                try:
+                    network = ipaddress.ip_network(str(network).strip(), strict=False)
+                except ValueError:
+                    continue
+                if network.version != 4:
+                    continue
+            ranges.append((int(network.network_address), int(network.broadcast_address)))
+
+        ranges.sort()
+        self.starts = array('I')
+        self.ends = array('I')
+        for start, end in ranges:
+            if self.ends and start <= self.ends[-1] + 1:
+                if end > self.ends[-1]:
+                    self.ends[-1] = end
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __contains__(self, ip) -> bool:
+        if not self.starts:
+            return False
+        if not isinstance(ip, int):
+            try:
+                ip = ip_to_int(ip)
+            except (OSError, ValueError, TypeError):
+                return False
+        index = bisect.bisect_right(self.starts, ip) - 1
+        return index >= 0 and ip <= self.ends[index]
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def __bool__(self) -> bool:
+        return bool(self.starts)
+
 async def get_cloudflare_ips():
     try:
         async with httpx.AsyncClient() as client:
             response = await client.get("https://www.cloudflare.com/ips-v4/")
             response.raise_for_status()
-            text = response.text
-            cloudflare_ips = set()
-            for line in text.splitlines():
-                line = line.strip()
-                if '/' in line:
-                    try:
-                        ip_network = ipaddress.ip_network(line)
-                        for ip in ip_network:
-                            cloudflare_ips.add(str(ip))
-                    except ValueError:
-                        continue
-            return cloudflare_ips
+            return IPRangeSet(line for line in response.text.splitlines() if '/' in line)
     except Exception as e:
         print("Ошибка при получении IP адресов Cloudflare:", e)
-        return set()
+        return IPRangeSet()
 
 def check_include_cloudflare(cloudflare):
     if cloudflare in ['yes', 'y', 'no', 'n']:
@@ -162,32 +204,55 @@ def group_ips_in_subnets_optimized(filename: str, subnet: str):
     except Exception as e:
         print(f"Ошибка при обработке файла: {e}")
 
-def split_file_by_lines(filename: str, max_lines: int = 999):
-    try:
-        with open(filename, 'r', encoding='utf-8') as file:
-            lines = file.readlines()
-
-        total_lines = len(lines)
+OUTPUT_FORMATS = {
+    'win': 'route add {ip} mask {mask} {gateway}',
+    'unix': 'ip route {ip}/{prefixlen} {gateway}',
+    'keenetic bat': 'route add {ip} mask {mask} 0.0.0.0',
+    'keenetic cli': 'ip route {ip}/{prefixlen} {ken_gateway} auto !{comment}',
+    'cidr': '{ip}/{prefixlen}',
+    'ovpn': 'push "route {ip} {mask}"',
+    'mikrotik': '/ip/firewall/address-list add list={list_name}{mk_comment} address={ip}/{prefixlen}',
+    'wireguard': '{ip}/{prefixlen}'
+}
+
+OUTPUT_SEPARATORS = {'wireguard': ', '}
+
+OUTPUT_MAX_LINES = {'keenetic bat': 999}
+
+def compile_template(template: str, constants: dict):
+    parts = template.format_map({**constants, 'ip': '\0'}).split('\0')
+    return lambda ip: ip.join(parts)
+
+def write_lines(filename: str, lines, separator: str = '\n', max_lines: int = 0):
+    lines = iter(lines)
+    if not max_lines:
+        with open(filename, 'w', encoding='utf-8', buffering=1 << 16) as file:
+            for index, chunk in enumerate(iter(lambda: list(itertools.islice(lines, 4096)), [])):
+                file.write((separator if index else '') + separator.join(chunk))
+        return False
 
-        if total_lines <= max_lines:
-            return False
+    part = list(itertools.islice(lines, max_lines))
+    next_part = list(itertools.islice(lines, max_lines))
+    if not next_part:
+        with open(filename, 'w', encoding='utf-8') as file:
+            file.write(separator.join(part))
+        return False
 
+    try:
         base_name = filename.rsplit('.', 1)[0] if '.' in filename else filename
         extension = '.' + filename.rsplit('.', 1)[1] if '.' in filename else '.txt'
 
-        num_parts = (total_lines + max_lines - 1) // max_lines
-
         print(f"\n{Style.BRIGHT}Результаты сохранены в файлы:{Style.RESET_ALL}")
-        for part in range(num_parts):
-            start_index = part * max_lines
-            end_index = min((part + 1) * max_lines, total_lines)
-
-            part_filename = f"{base_name}_p{part + 1}{extension}"
+        num_parts = 0
+        while part:
+            num_parts += 1
+            part_filename = f"{base_name}_p{num_parts}{extension}"
 
             with open(part_filename, 'w', encoding='utf-8') as file:
-                file.writelines(lines[start_index:end_index])
+                file.write(separator.join(part) + (separator if next_part else ''))
 
-            print(f"{Style.BRIGHT}{part_filename} ({end_index - start_index} строк){Style.RESET_ALL}")
+            print(f"{Style.BRIGHT}{part_filename} ({len(part)} строк){Style.RESET_ALL}")
+            part, next_part = next_part, list(itertools.islice(lines, max_lines))
 
         print(f"{Style.BRIGHT}Разделение завершено. Создано {num_parts} частей{Style.RESET_ALL}")
 
@@ -201,6 +266,7 @@ def split_file_by_lines(filename: str, max_lines: int = 999):
     except Exception as e:
         print(f"{red('Ошибка при разделении файла:')} {e}")
         return False
+
 def process_file_format(filename, filetype, gateway, selected_service, mk_list_name, mk_comment, subnet, ken_gateway):
     def read_file(filename):
         try:
@@ -210,14 +276,6 @@ def process_file_format(filename, filetype, gateway, selected_service, mk_list_n
             print(f"Ошибка чтения файла: {e}")
             return None
 
-    def write_file(filename, ips, formatter):
-        formatted_ips = [formatter(ip.strip()) for ip in ips]
-        with open(filename, 'w', encoding='utf-8') as file:
-            if filetype.lower() == 'wireguard':
-                file.write(', '.join(formatted_ips))
-            else:
-                file.write('\n'.join(formatted_ips))
-
     net_mask = subnet if subnet == "mix" else "255.255.0.0" if subnet == "16" else "255.255.255.0" if subnet == "24" else "255.255.255.255"
 
     if not filetype:
@@ -257,43 +315,26 @@ def process_file_format(filename, filetype, gateway, selected_service, mk_list_n
     elif filetype == 'mikrotik':
         mk_list_name = mk_list_name_input(mk_list_name)
 
-    formatters = {
-        'win': lambda ip: f"route add {ip} mask {net_mask} {gateway}",
-        'unix': lambda ip: f"ip route {ip}/{subnet} {gateway}",
-        'keenetic bat': lambda ip: f"route add {ip} mask {net_mask} 0.0.0.0",
-        'keenetic cli': lambda ip: f"ip route {ip}/{subnet} {ken_gateway} auto !{comment(selected_service)}",
-        'cidr': lambda ip: f"{ip}/{subnet}",
-        'ovpn': lambda ip: f'push "route {ip} {net_mask}"',
-        'mikrotik': lambda ip: f'/ip/firewall/address-list add list={mk_list_name}' + (f' comment="{comment(selected_service)}"' if mk_comment != "off" else "") + f' address={ip}/{subnet}',
-        'wireguard': lambda ip: f"{ip}/{subnet}"
-    }
+    template = OUTPUT_FORMATS.get(filetype.lower())
+    if template is None:
+        return False
 
+    constants = {
+        'gateway': gateway,
+        'ken_gateway': ken_gateway,
+        'list_name': mk_list_name,
+        'comment': comment(selected_service),
+        'mk_comment': f' comment="{comment(selected_service)}"' if mk_comment != "off" else ""
+    }
     if subnet == "mix":
-        if filetype in ['win', 'keenetic bat']:
-            mix_formatter = lambda ip: f"{ip.strip()} mask 255.255.255.0" if ip.endswith('.0') else f"{ip.strip()} mask 255.255.255.255"
-        elif filetype.lower() == 'ovpn':
-            mix_formatter = lambda ip: f"{ip.strip()} 255.255.255.0" if ip.endswith('.0') else f"{ip.strip()} 255.255.255.255"
-        else:
-            mix_formatter = lambda ip: f"{ip.strip()}/24" if ip.endswith('.0') else f"{ip.strip()}/32"
-
-        formatters.update({
-            'win': lambda ip: f"route add {mix_formatter(ip)} {gateway}",
-            'unix': lambda ip: f"ip route {mix_formatter(ip)} {gateway}",
-            'keenetic bat': lambda ip: f"route add {mix_formatter(ip)} 0.0.0.0",
-            'keenetic cli': lambda ip: f"ip route {mix_formatter(ip)} {ken_gateway} auto !{comment(selected_service)}",
-            'cidr': lambda ip: f"{mix_formatter(ip)}",
-            'ovpn': lambda ip: f'push "route {mix_formatter(ip)}"',
-            'mikrotik': lambda ip: f'/ip/firewall/address-list add list={mk_list_name}' + (f' comment="{comment(selected_service)}"' if mk_comment != "off" else "") + f' address={mix_formatter(ip)}',
-            'wireguard': lambda ip: f"{mix_formatter(ip)}"
-        })
-
-    if filetype.lower() in formatters:
-        write_file(filename, ips, formatters[filetype.lower()])
-
-        if filetype.lower() == 'keenetic bat':
-            return split_file_by_lines(filename, max_lines=999)
+        network = compile_template(template, {**constants, 'mask': '255.255.255.0', 'prefixlen': '24'})
+        host = compile_template(template, {**constants, 'mask': '255.255.255.255', 'prefixlen': '32'})
+        lines = ((network if ip.endswith('.0') else host)(ip) for ip in map(str.strip, ips))
+    else:
+        formatter = compile_template(template, {**constants, 'mask': net_mask, 'prefixlen': subnet})
+        lines = (formatter(ip) for ip in map(str.strip, ips))
 
-    return False
+    return write_lines(filename, lines, OUTPUT_SEPARATORS.get(filetype.lower(), '\n'), OUTPUT_MAX_LINES.get(filetype.lower(), 0))
 
 async def main():
     filename = "ip.txt"
@@ -326,9 +367,9 @@ async def main():
     if include_cloudflare:
         cloudflare_ips = await get_cloudflare_ips()
     else:
-        cloudflare_ips = set()
+        cloudflare_ips = IPRangeSet()
 
-    ips -= cloudflare_ips
+    ips = {ip for ip in ips if ip not in cloudflare_ips}
 
     with open(filename, 'w', encoding='utf-8') as file:
         for ip in sorted(ips):